@@ -8,6 +8,7 @@ class columnList(widget):
 	"""
 	Displays a list of data with columns
 	List can be sorted and filtered arbitrarily
+	Items added with a key can be replaced in place
 
 	Inherited methods:
 	hide(self)
@@ -63,6 +64,7 @@ class columnList(widget):
 		self.columns = []
 		self.items = []
 		self.filteredItems = []
+		self.keyed = {}
 
 		## Position variables
 		self.row = 0
@@ -209,20 +211,98 @@ class columnList(widget):
 
 		self.display()#}}}
 		
-	def addItem(self, item):#{{{
+	def addItem(self, item, key=None):#{{{
 		"""
 		Add an item, and resort/display it
 		if it matches current filter
 
 		argument:
 		item -- item to add
-		"""
+		key -- identity for updateItem, an item added with a key
+		       already in the list replaces it (default = None)
+		"""
+		if key is not None:
+			if key in self.keyed:
+				self.updateItem( key, item )
+				return
+			self.keyed[ key ] = item
 		self.items.append( item )
 		if self.filter( item ):
 			self.filteredItems.append( item )
 			self.filteredItems = sorted( self.filteredItems, key=self.sortkey )
 		self.display()#}}}
 
+	def updateItem(self, key, item):#{{{
+		"""
+		Replace the item added with a given key and move
+		its row to where it sorts now. The selection and
+		the rows on screen stay put and only rows that
+		changed are redrawn. Items are replaced, not changed
+		in place, so the list stays sorted by the current
+		sort keys and the new row is found by binary search
+
+		arguments:
+		key -- key the item was added with
+		item -- the new item
+		"""
+		old = self.keyed.get( key )
+		if old is None:
+			self.addItem( item, key )
+			return
+		self.keyed[ key ] = item
+		self.items[ self.items.index( old ) ] = item
+
+		self.displayItems[ 1 + self.row - self.firstrow ] = False
+		selected = self.row < len( self.filteredItems ) and self.filteredItems[ self.row ] is old
+		try:
+			row = self.filteredItems.index( old )
+			del self.filteredItems[ row ]
+			self.shiftRows( row, -1 )
+		except ValueError:
+			pass
+		row = None
+		if self.filter( item ):
+			value = self.sortkey( item )
+			lo, hi = 0, len( self.filteredItems )
+			while lo < hi:
+				mid = ( lo + hi ) // 2
+				if value < self.sortkey( self.filteredItems[ mid ] ):
+					hi = mid
+				else:
+					lo = mid + 1
+			row = lo
+			self.filteredItems.insert( row, item )
+			self.shiftRows( row, 1 )
+			if selected:
+				self.row = row
+
+		self.row = max( 0, min( self.row, len( self.filteredItems ) - 1 ) )
+		## Keep the selection on screen
+		if self.row < self.firstrow:
+			self.firstrow = self.row
+		elif self.row - self.firstrow > self.height - 2:
+			self.firstrow = self.row - self.height + 2
+		self.displayItems[ 1 + self.row - self.firstrow ] = False
+		if row is not None:
+			self.displayItems[ 1 + row - self.firstrow ] = False
+		self.display()#}}}
+
+	def shiftRows( self, row, n ):#{{{
+		"""
+		Move the selection and first row shown along when n
+		rows are inserted at row, or -n rows removed there
+
+		arguments:
+		row -- where the rows were inserted/removed
+		n -- number of rows, negative if removed
+		"""
+		if row < self.firstrow:
+			self.firstrow = max( row, self.firstrow + n )
+		if n > 0 and row <= self.row:
+			self.row += n
+		elif n < 0 and row < self.row:
+			self.row = max( row, self.row + n )#}}}
+
 	def getItem(self, index):#{{{
 		"""
 		Return the item at a given index
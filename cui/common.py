@@ -15,6 +15,8 @@ KEY_TABNEXT = [ ord(x) for x in '\t' ]
 KEY_TABPREV = [ curses.KEY_BTAB ]
 KEY_ADDFAV = [ ord(x) for x in 'f' ]
 KEY_DELFAV = [ ord(x) for x in 'F' ]
+KEY_WATCH = [ ord(x) for x in 'v' ]
+KEY_AUTOJOIN = [ ord(x) for x in 'J' ]
 
 ## Navigation
 KEY_UP = [ ord(x) for x in 'wuk' ] + [ curses.KEY_UP ]
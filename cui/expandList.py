@@ -1,5 +1,5 @@
 #!/usr/bin/env python2
-import curses
+import curses, itertools, threading
 from curses import panel
 from .widget import widget
 from .common import *
@@ -9,6 +9,15 @@ class expandList(widget):
 	Displays a list of data with columns
 	List can be sorted and filtered arbitrarily
 	Items can be expanded to show a list of strings
+	Items added with a key can be updated in place
+
+	Items may be added and updated from other threads.
+	Changes are made under a lock and published as an
+	immutable snapshot by swapping a single reference;
+	display() draws whatever snapshot is current without
+	locking, so writers never wait for the screen. Lists
+	changed by other threads are only marked dirty, the
+	UI thread redraws them.
 
 	Inherited methods:
 	hide(self)
@@ -54,17 +63,38 @@ class expandList(widget):
 		"""
 		class to hold item and its expanded data
 		"""
-		def __init__( self, item, expdata=[] ):#{{{
+		## tells apart items whose sort values are equal
+		order = itertools.count()
+
+		def __init__( self, item, expdata=[], key=None ):#{{{
 			"""
 			listItem constructor
 
 			arguments:
 			item -- item to be contained
-			expdata -- list of strings as expanded data (default = [])
+			expdata -- list of strings as expanded data, or function
+			           returning it on first expansion (default = [])
+			key -- identity of the item for updates (default = None)
 			"""
 			self.item = item
-			self.expdata = expdata
-			self.expanded = False#}}}
+			self._expdata = expdata
+			self.expanded = False
+			self.key = key
+			self.seq = next( self.order )
+			self.sortkey = None
+			## bumped on updates so the row gets redrawn
+			self.version = 0#}}}
+
+		def getExpdata( self ):#{{{
+			"""
+			Return expanded data, calling the function
+			given as expdata the first time
+			"""
+			if callable( self._expdata ):
+				self._expdata = self._expdata()
+			return self._expdata#}}}
+
+		expdata = property( getExpdata )
 
 		def toggleExpand( self ):#{{{
 			"""
@@ -74,6 +104,26 @@ class expandList(widget):
 		
 		#}}}
 
+	class snapshot( object ):#{{{
+		"""
+		Immutable view of the list published for drawing
+		"""
+		__slots__ = ( 'rows', 'row', 'firstrow' )
+
+		def __init__( self, rows, row, firstrow ):#{{{
+			"""
+			snapshot constructor
+
+			arguments:
+			rows -- tuple of the rows shown, listItems and expanded data
+			row -- index of the selected row
+			firstrow -- index of the first row on screen
+			"""
+			self.rows = rows
+			self.row = row
+			self.firstrow = firstrow#}}}
+		#}}}
+
 	def __init__(self, window):#{{{
 		"""
 		Create item holders and fake filters
@@ -90,6 +140,12 @@ class expandList(widget):
 		self.columns = []
 		self.items = []
 		self.filteredItems = []
+		## listItems shown, in display order, with the sort keys
+		## they were placed by; filteredItems adds expanded rows
+		self.sortedItems = []
+		self.sortKeys = []
+		self.keyed = {}
+		self.lock = threading.RLock()
 
 		## Position variables
 		self.row = 0
@@ -97,6 +153,10 @@ class expandList(widget):
 		self.maxrow = 0
 		self.paused = False
 
+		## What display() draws, swapped in by publish()
+		self.view = self.snapshot( (), 0, 0 )
+		self.dirty = False
+
 		## Display variables
 		self.displayItems = {} # Dictionary is convenience to avoid some invalid-index checks
 		self.spacers = 2
@@ -118,11 +178,13 @@ class expandList(widget):
 
 	def display(self):#{{{
 		"""
-		Draw column headers and items
+		Draw column headers and items of the current snapshot
 		Attempts to refresh only what has been updated
 		"""
 		if self.paused:
 			return
+		self.dirty = False
+		view = self.view
 
 		if not self.columns:
 			self.window.move(0, 0)
@@ -138,18 +200,21 @@ class expandList(widget):
 			self.window.addstr( 0, x, column.title[:w].ljust( w ), mode )
 			x += w+1
 
-		for index in range( len(self.filteredItems) ):
-			y = 1 - self.firstrow + index
+		for index in xrange( view.firstrow, len( view.rows ) ):
+			y = 1 - view.firstrow + index
 			if y >= self.height: break
 
-			listItem = self.filteredItems[ index ]
+			listItem = view.rows[ index ]
 
-			if self.displayItems.get( y, False ) == listItem:
+			## Redraw rows showing another item, an updated one,
+			## or whose selection changed
+			state = ( listItem, getattr( listItem, 'version', 0 ), index == view.row )
+			if self.displayItems.get( y, False ) == state:
 				continue
 			else:
-				self.displayItems[ y ] = listItem
+				self.displayItems[ y ] = state
 
-			mode = curses.A_REVERSE * ( index == self.row )
+			mode = curses.A_REVERSE * ( index == view.row )
 			if y > 0:
 				self.printColor( y, 1, '', mode=mode)
 			x = 1
@@ -163,11 +228,12 @@ class expandList(widget):
 				w = self.width - 4
 				self.printColor( y, 3, listItem, w, mode )
 
-		y = self.maxrow - self.firstrow + 1
+		y = max( 1, len( view.rows ) - view.firstrow + 1 )
 		while y < self.height:
 			## self.window.clrtobot() wasn't working for me
 			## TODO investigate this
 			self.printColor( y, 1, '')
+			self.displayItems.pop( y, None )
 			y += 1
 
 		self.window.nooutrefresh()#}}}
@@ -222,13 +288,31 @@ class expandList(widget):
 		"""
 		Empty list of items and clear window
 		"""
-		self.items = []
-		self.filteredItems = []
-		self.row = 0
-		self.firstrow = 0
-		self.maxrow = 0
+		with self.lock:
+			self.items = []
+			self.filteredItems = []
+			self.sortedItems = []
+			self.sortKeys = []
+			self.keyed = {}
+			self.row = 0
+			self.firstrow = 0
+			self.maxrow = 0
+			self.publish()
 		self.clear()#}}}
 
+	def publish( self, rows=True ):#{{{
+		"""
+		Swap in a snapshot of the current rows and position
+		for drawing and mark the list dirty. Call with the
+		lock held
+
+		arguments:
+		rows -- False if only the position changed (default = True)
+		"""
+		shown = tuple( self.filteredItems ) if rows else self.view.rows
+		self.view = self.snapshot( shown, self.row, self.firstrow )
+		self.dirty = True#}}}
+
 	def handleInput( self, key ):#{{{
 		"""
 		Handles a given keypress
@@ -265,51 +349,175 @@ class expandList(widget):
 		if n == 0:
 			return
 
-		self.displayItems[ 1 + self.row - self.firstrow ] = False
-		self.row += n
-		self.displayItems[ 1 + self.row - self.firstrow ] = False
+		with self.lock:
+			self.row += n
 
-		## Do we even have items? Or is it top of list?
-		if self.maxrow == 0 or self.row < 0:
-			if self.firstrow != 0:
-				self.displayItems = {}
+			## Do we even have items? Or is it top of list?
+			if self.maxrow == 0 or self.row < 0:
 				self.firstrow = 0
-			else:
-				self.displayItems[ 1 ] = False
-			self.row = 0
+				self.row = 0
 
-		## End of list?
-		if self.row >= self.maxrow:
-			self.row = self.maxrow-1
-			self.displayItems[ 1 + self.row ] = False
+			## End of list?
+			if self.row >= self.maxrow:
+				self.row = max( 0, self.maxrow-1 )
 
-		## Scroll down?
-		if self.row - self.firstrow > self.height - 2:
-			self.firstrow = self.row - self.height + 2
-			self.displayItems = {}
+			## Scroll down?
+			if self.row - self.firstrow > self.height - 2:
+				self.firstrow = self.row - self.height + 2
 
-		## Scroll up?
-		if self.row < self.firstrow:
-			self.firstrow = self.row
-			self.displayItems = {}
+			## Scroll up?
+			if self.row < self.firstrow:
+				self.firstrow = self.row
 
+			self.publish( rows=False )
 		self.display()#}}}
 		
-	def addItem(self, item, expdata=[]):#{{{
+	def addItem(self, item, expdata=[], key=None):#{{{
 		"""
-		Add an item, and resort/display it
+		Add an item, and insert/display it
 		if it matches current filter
 
 		argument:
 		item -- item to add
-		expdata -- string of lists to show when item is expanded (default = [])
+		expdata -- list of strings to show when item is expanded,
+		           or function returning it (default = [])
+		key -- identity for updateItem, an item added with a key
+		       already in the list updates it (default = None)
+		"""
+		with self.lock:
+			if key is not None and key in self.keyed:
+				self.updateItem( key, item, expdata )
+				return
+			listItem = self.listItem( item, expdata, key )
+			self.items.append( listItem )
+			if key is not None:
+				self.keyed[ key ] = listItem
+			self.insertRows( listItem )
+			self.publish()#}}}
+
+	def updateItem(self, key, item, expdata=None):#{{{
+		"""
+		Replace the item added with a given key, or changed
+		in place, and move its row to where it sorts now.
+		The selection and the rows on screen stay put and
+		only rows that changed get redrawn
+
+		arguments:
+		key -- key the item was added with
+		item -- the new item
+		expdata -- new expanded data (default = keep it)
+		"""
+		with self.lock:
+			listItem = self.keyed.get( key )
+			if listItem is None:
+				self.addItem( item, expdata if expdata is not None else [], key )
+				return
+			selected = self.getSelectedListItem() is listItem
+			removed = self.removeRows( listItem )
+			if removed:
+				self.shiftRows( removed[0], -removed[1] )
+			listItem.item = item
+			listItem.version += 1
+			if expdata is not None:
+				listItem._expdata = expdata
+			inserted = self.insertRows( listItem )
+			row = None
+			if inserted:
+				row = inserted[0]
+				self.shiftRows( row, inserted[1] )
+				if selected:
+					self.row = row
+			self.row = max( 0, min( self.row, self.maxrow - 1 ) )
+			## Keep the selection on screen
+			if self.row < self.firstrow:
+				self.firstrow = self.row
+			elif self.row - self.firstrow > self.height - 2:
+				self.firstrow = self.row - self.height + 2
+			self.publish()#}}}
+
+	def findPosition( self, sortkey ):#{{{
+		"""
+		Binary search where a listItem with the given
+		sort key goes in sortedItems
+
+		arguments:
+		sortkey -- (value, seq) as in listItem.sortkey
 		"""
-		listItem = self.listItem( item, expdata )
-		self.items.append( listItem )
-		if self.filter( listItem ):
-			self.filteredItems.append( listItem )
-			self.maxrow += 1
-			self.sort()#}}}
+		lo, hi = 0, len( self.sortKeys )
+		while lo < hi:
+			mid = ( lo + hi ) // 2
+			if self.reversed:
+				before = self.sortKeys[ mid ] > sortkey
+			else:
+				before = self.sortKeys[ mid ] < sortkey
+			if before:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo#}}}
+
+	def removeRows( self, listItem ):#{{{
+		"""
+		Take a listItem and its expanded rows out of the
+		view, if shown. Return the row they were at and
+		their number, or None. Call with the lock held
+
+		arguments:
+		listItem -- the listItem to remove
+		"""
+		if listItem.sortkey is None:
+			return
+		n = self.findPosition( listItem.sortkey )
+		if n == len( self.sortedItems ) or self.sortedItems[ n ] is not listItem:
+			return None
+		row = self.filteredItems.index( listItem )
+		count = 1 + ( len( listItem.expdata ) if listItem.expanded else 0 )
+		del self.sortedItems[ n ]
+		del self.sortKeys[ n ]
+		del self.filteredItems[ row:row+count ]
+		self.maxrow -= count
+		return ( row, count )#}}}
+
+	def insertRows( self, listItem ):#{{{
+		"""
+		Put a listItem and its expanded rows where it sorts,
+		if it matches the filter. Return the row they went
+		to and their number, or None. Call with the lock held
+
+		arguments:
+		listItem -- the listItem to insert
+		"""
+		if not self.filter( listItem ):
+			listItem.sortkey = None
+			return None
+		listItem.sortkey = ( self.sortkey( listItem ), listItem.seq )
+		n = self.findPosition( listItem.sortkey )
+		if n < len( self.sortedItems ):
+			row = self.filteredItems.index( self.sortedItems[ n ] )
+		else:
+			row = len( self.filteredItems )
+		rows = [ listItem ] + ( listItem.expdata if listItem.expanded else [] )
+		self.sortedItems.insert( n, listItem )
+		self.sortKeys.insert( n, listItem.sortkey )
+		self.filteredItems[ row:row ] = rows
+		self.maxrow += len( rows )
+		return ( row, len( rows ) )#}}}
+
+	def shiftRows( self, row, n ):#{{{
+		"""
+		Move the selection and first row shown along when n
+		rows are inserted at row, or -n rows removed there
+
+		arguments:
+		row -- where the rows were inserted/removed
+		n -- number of rows, negative if removed
+		"""
+		if row < self.firstrow:
+			self.firstrow = max( row, self.firstrow + n )
+		if n > 0 and row <= self.row:
+			self.row += n
+		elif n < 0 and row < self.row:
+			self.row = max( row, self.row + n )#}}}
 
 	def getItem(self, index):#{{{
 		"""
@@ -325,6 +533,23 @@ class expandList(widget):
 		"""
 		toggle expansion of currently selected item
 		"""
+		## Expanded data may be slow to get, don't hold up
+		## writers meanwhile
+		listItem = self.getSelectedListItem()
+		if listItem is None:
+			return
+		if not listItem.expanded:
+			listItem.expdata
+		with self.lock:
+			self.toggleRows()
+			self.publish()
+		self.display() #}}}
+
+	def toggleRows( self ):#{{{
+		"""
+		Add or remove the expanded rows of the selected
+		item. Call with the lock held
+		"""
 		index = self.getSelectedIndex()
 		listItem = self.filteredItems[ index ]
 		if listItem.expanded:
@@ -332,12 +557,10 @@ class expandList(widget):
 			self.filteredItems = self.filteredItems[:index+1] + self.filteredItems[index+1+len(listItem.expdata):]
 			self.maxrow -= len( listItem.expdata )
 			self.row = index
-			self.displayItems[ 1 + self.row - self.firstrow ] = False
 		else:
 			listItem.expanded = True
 			self.filteredItems = self.filteredItems[:index+1] + listItem.expdata + self.filteredItems[index+1:]
-			self.maxrow += len( listItem.expdata )
-		self.display() #}}}
+			self.maxrow += len( listItem.expdata )#}}}
 
 	def getItems(self):#{{{
 		"""
@@ -350,25 +573,49 @@ class expandList(widget):
 		Return filtered item list
 		"""
 		result = []
-		for listItem in self.filteredItems:
+		for listItem in self.view.rows:
 			if isinstance( listItem, self.listItem ):
 				result.append( listItem.item )
 		return result#}}}
 
-	def getSelectedIndex( self ):#{{{
+	def getVisibleItems(self):#{{{
+		"""
+		Return the items currently on screen
+		"""
+		view = self.view
+		rows = view.rows[ view.firstrow : view.firstrow + self.height - 1 ]
+		return [ x.item for x in rows if isinstance( x, self.listItem ) ]#}}}
+
+	def getSelectedIndex( self, view=None ):#{{{
 		"""
 		Get index of currently selected item
+
+		arguments:
+		view -- snapshot to look in (default = the current one)
 		"""
-		index = self.row
-		while not isinstance( self.filteredItems[index] , self.listItem ) and index > -1:
+		if view is None:
+			view = self.view
+		index = view.row
+		while index > -1 and not isinstance( view.rows[index] , self.listItem ):
 			index -= 1
 		return index#}}}
 
+	def getSelectedListItem(self):#{{{
+		"""
+		Return the listItem of the selected row, None
+		if the list is empty
+		"""
+		view = self.view
+		if not view.rows:
+			return None
+		return view.rows[ self.getSelectedIndex( view ) ]#}}}
+
 	def getSelectedItem(self):#{{{
 		"""
 		Return currently highlighted item
 		"""
-		return self.filteredItems[ self.getSelectedIndex() ].item#}}}
+		view = self.view
+		return view.rows[ self.getSelectedIndex( view ) ].item#}}}
 
 	def setFilter( self, filt ):#{{{
 		"""
@@ -396,15 +643,26 @@ class expandList(widget):
 		"""
 		Sort items by given sortkey and filter
 		"""
-		self.filteredItems = sorted( filter( self.filter, self.items ), key=self.sortkey, reverse=self.reversed )
-		n = 0
-		while n < len( self.filteredItems ):
-			if isinstance(self.filteredItems[ n ], self.listItem) and self.filteredItems[n].expanded:
-				expdata = self.filteredItems[n].expdata
-				self.filteredItems = self.filteredItems[:n+1] + expdata + self.filteredItems[n+1:]
-				n += len( expdata )
-			n += 1
-		self.maxrow = len( self.filteredItems )
+		with self.lock:
+			for listItem in self.items:
+				listItem.sortkey = None
+			shown = filter( self.filter, self.items )
+			for listItem in shown:
+				listItem.sortkey = ( self.sortkey( listItem ), listItem.seq )
+			self.sortedItems = sorted( shown, key=lambda x: x.sortkey, reverse=self.reversed )
+			self.sortKeys = [ x.sortkey for x in self.sortedItems ]
+			self.filteredItems = []
+			for listItem in self.sortedItems:
+				self.filteredItems.append( listItem )
+				if listItem.expanded:
+					self.filteredItems.extend( listItem.expdata )
+			self.maxrow = len( self.filteredItems )
+			## The list may have shrunk below the selection
+			if self.row >= self.maxrow:
+				self.row = max( 0, self.maxrow - 1 )
+			if self.firstrow > self.row:
+				self.firstrow = self.row
+			self.publish()
 		self.display()#}}}
 
 	def reverse( self ):#{{{
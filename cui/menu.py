@@ -515,3 +515,20 @@ class menu( widget ):
 		self.options.append( inputBox )
 		self.maxrow += 1
 		return inputBox#}}}
+
+	def delOption( self, option ):#{{{
+		"""
+		Remove an option added before, the selection
+		stays in the list. Redraw with display() after
+
+		arguments:
+		option -- the option object returned when it was added
+		"""
+		self.options.remove( option )
+		self.maxrow -= 1
+		if self.row >= self.maxrow:
+			self.row = max( 0, self.maxrow-1 )
+		if self.firstrow > self.row:
+			self.firstrow = self.row
+		## the last row isn't drawn over anymore
+		self.clear()#}}}
@@ -10,6 +10,10 @@ class statusContainer(widget):
 	Subwidget is displayed in remaining area
 	statusContainer passes focus to subwidget
 
+	Messages may be set from other threads, they are
+	only stored and marked dirty; the UI thread draws
+	them with display()
+
 	Inherited methods:
 	getPanel( self )
 	getWindow( self )
@@ -27,6 +31,7 @@ class statusContainer(widget):
 		self.subwindow = None
 		self.message = ''
 		self.mode = curses.A_NORMAL
+		self.dirty = False
 		self.widget = None#}}}
 
 	def hide( self ):#{{{
@@ -78,6 +83,7 @@ class statusContainer(widget):
 		Draw a status message at the given position with given properties
 		defaults to writing rest of line with normal mode
 		"""
+		self.dirty = False
 		width = self.width - 1
 		self.window.addstr( self.height-1, 0, self.message[:width].ljust(width), self.mode )
 		self.window.nooutrefresh()#}}}
@@ -139,7 +145,8 @@ class statusContainer(widget):
 
 	def setMessage(self, message, mode=None):#{{{
 		"""
-		Set status container message
+		Set status container message, drawn by the
+		next display()
 
 		arguments:
 		message -- mesage to display
@@ -148,7 +155,7 @@ class statusContainer(widget):
 		self.message = message
 		if mode != None:
 			self.mode = mode
-		self.display()#}}}
+		self.dirty = True#}}}
 	
 	def getMessage(self):#{{{
 		"""
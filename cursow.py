@@ -1,5 +1,5 @@
 #!/usr/bin/env python2
-import curses, threading, time, os, sys
+import curses, threading, time, os, sys, socket, sqlite3
 from curses import panel
 
 import cui
@@ -9,6 +9,14 @@ from net import ConnectionError
 
 class cursow(object):
 
+	## Scan priorities, lower ones are queried first
+	PRIO_FIRST = 0 # favorites and rows on screen
+	PRIO_MATCHING = 1 # matched the filter last scan
+	PRIO_OTHER = 2
+
+	## Seconds between polls of watched and auto-join servers
+	POLL_INTERVAL = 0.5
+
 	def __init__(self,screen):#{{{
 		## curses options
 		curses.curs_set(0)
@@ -17,8 +25,33 @@ class cursow(object):
 		self.stdscr.keypad(1)
 
 		self.settings = settings()
+		self.negcache = negcache.NegativeCache( self.settings.negcache )
+		self.pool = connection.SocketPool( 32 )
+		self.window = scheduler.Window( maximum=self.pool.size )
+		self.servers = {}
+		self.rejected = {}
+		self.rejectLock = threading.Lock()
+		self.playerIndex = friends.PlayerIndex()
+		self.friendsChanged = False
+		self.events = events.PlayerEvents()
+		self.events.subscribe( self.showPlayerEvent )
+		self.eventLog = None
+		self.recorder = None
+		self.detailing = {}
+		self.refreshing = False
+		self.matching = set()
+		self.intervals = scheduler.Intervals()
+		self.history = history.History()
+		self.scheduler = None
+		self.visibleKeys = set()
+		self.watched = None
+		self.autojoin = {}
+		self.joining = None
 		self.initSrvlst()
 		self.initMenus()
+		self.initRules()
+		self.openPlayerLog()
+		self.openRecorder()
 		self.focusedWidget = self.srvlst
 
 		panel.update_panels()
@@ -26,10 +59,29 @@ class cursow(object):
 
 		self.startQuery()
 
+		## Scanner threads only mark the server list dirty, it
+		## is redrawn here at least every 100ms
+		self.stdscr.timeout( 100 )
+
 		## Main Loop -- have to catch all quit events here
 		while True:
 			key = self.stdscr.getch()
 
+			## An auto-join server has a free slot
+			if self.joining is not None:
+				self.launch( self.joining )
+				self.quit()
+				break
+
+			if key == -1:
+				if self.srvlst.dirty and self.focusedWidget == self.srvlst:
+					self.srvlst.display()
+					self.prioritizeVisible()
+					self.detailVisible()
+				self.drawChanges()
+				curses.doupdate()
+				continue
+
 			if key in cui.KEY_QUIT:
 				self.quit()
 				break
@@ -42,6 +94,11 @@ class cursow(object):
 			else:
 				self.handleInput( key )
 
+			if self.srvlst.dirty and self.focusedWidget == self.srvlst:
+				self.srvlst.display()
+			self.prioritizeVisible()
+			self.detailVisible()
+			self.drawChanges()
 			curses.doupdate()#}}}
 	
 	##########
@@ -52,15 +109,29 @@ class cursow(object):
 		"""
 		Stop current server threads and restart query process
 		"""
+		## Auto-joins outlast a refresh
+		joins = [ srv for srv, stop in self.autojoin.values() ]
 		self.stopServers()
 
 		self.stop = False
+		self.started = time.time()
 		self.serverips = set()
+		## Remember what matches the filter to ask it first
+		self.matching = set( key for key, srv in self.servers.items() if self.filter( srv ) )
+		self.servers = {}
+		self.rejected = {}
+		self.detailing = {}
+		self.refreshing = False
+		self.intervals.clear()
+		self.playerIndex.clear()
+		self.updateFriends()
 		self.settings.clearGametype()
 		self.settings.clearMod()
 		self.srvlst.reset()
 		self.mainThread = threading.Thread(target=self.queryMasters)
-		self.mainThread.start()#}}}
+		self.mainThread.start()
+		for srv in joins:
+			self.startAutoJoin( srv )#}}}
 	
 	def queryMasters(self):#{{{
 		if self.settings.getShowFavorites():
@@ -68,74 +139,520 @@ class cursow(object):
 				self.status.setMessage( 'Adding Favorite: %s' % (host) )
 				if self.stop:
 					return
-				self.serverips.add( host )
-				curses.doupdate()
+				try:
+					self.serverips.add( address.from_string( host ) )
+				except ( ValueError, socket.error ):
+					continue
 		else:
 			for host, port, protocol, opts  in self.settings.getMasters():
 				if self.stop:
 					return
 				try:
 					self.status.setMessage( 'Querying Master Server: %s %d %d %s' % (host, port, protocol, opts) )
-					curses.doupdate()
 					self.serverips |= server.MasterServer( host, port=port, protocol=protocol, options=opts )
 				except:
 					continue
+		# servers that replied in earlier scans make their timeouts count as losses
+		self.window = scheduler.Window( maximum=self.pool.size, answered=self.window.answered )
+		budget = self.settings.getDeadline()
+		deadline = None if budget == 'none' else self.started + float( budget )
+		scan = scheduler.Scheduler( [], self.window, int( self.settings.getPerHost() ),
+				deadline=deadline )
+
+		favorites = set()
+		for host in self.settings.getFav():
+			try:
+				favorites.add( address.from_string( host ) )
+			except ( ValueError, socket.error ):
+				continue
+
+		## Leave out servers that keep not answering,
+		## probe them once when their backoff is over
+		self.skippedServers = 0
+		skipDead = self.settings.getSkipDead()
+		for key in self.serverips:
+			if key in favorites:
+				priority = self.PRIO_FIRST
+			elif key in self.matching:
+				priority = self.PRIO_MATCHING
+			else:
+				priority = self.PRIO_OTHER
+			state = self.negcache.check( key ) if skipDead else self.negcache.QUERY
+			if state == self.negcache.SKIP:
+				self.skippedServers += 1
+			elif state == self.negcache.PROBE:
+				scan.add( key, attempts=1, priority=priority )
+			else:
+				scan.add( key, priority=priority )
+		self.scheduler = scan
 		self.processedServers = 0
-		self.totalServers = len( self.serverips )
+		self.totalServers = len( self.serverips ) - self.skippedServers
 		self.mainThread = threading.Thread(target=self.processServers)
 		self.mainThread.start()#}}}
 	
-	def processServer(self, ip):#{{{
+	def processServer(self, key):#{{{
 		"""
 		Try to get/parse a status response from a server
 
 		arguments:
-		ip -- ip:port string of server
+		key -- packed address of server, see net.address
 		"""
 		try:
-			## Create Server Object
-			host = ip.split(':')
-			srv = server.Server( host[0], int(host[1]) )
-
-			## Get Server information
-			srv.getstatus()
-			if self.settings.getPing(): srv.getPing()
+			## Refreshes parse into the listed server object,
+			## otherwise create one
+			with self.rejectLock:
+				srv = self.servers.get( key ) or self.rejected.get( key )
+			refresh = srv is not None
+			if not refresh:
+				host, port = address.unpack( key )
+				srv = server.Server( host, port, key=key )
 
-			## Update others with new information
-			expdata =  [ p.name for p in srv.players  ]
-			self.srvlst.addItem( srv, expdata )
+			## Get Server information, players are left
+			## unparsed until they are needed; in two phases
+			## they aren't even asked for unless wanted
+			filt = self.filter
+			twoPhase = self.settings.getTwoPhase()
+			detail = self.detailing.pop( key, None ) is not None
+			query = srv.getinfo if twoPhase and not srv.detailed and not detail else srv.getstatus
+			## The scheduler does the retrying
+			hedge = self.window.get_rtt() if self.settings.getHedge() else None
+			timeout = self.scheduler.timeout( 1.0 )
+			start, ok, retry = time.time(), False, False
+			digest = srv.digest
+			try:
+				accepted = query( filt, self.pool, hedge, timeout, retries=1 )
+				ok = True
+			finally:
+				retry = self.scheduler.done( key, ok, time.time() - start )
+				if ok:
+					self.negcache.success( key )
+				elif not retry and key not in self.scheduler.cutoff:
+					self.negcache.failure( key )
+				if refresh and not retry and self.refreshing and not self.isWatched( key ):
+					self.scheduler.add( key, priority=self.PRIO_OTHER,
+							delay=self.intervals.next( key, srv.clients if ok else None ) )
+			sampled = self.history.add( key, srv.clients )
+			if self.recorder is not None:
+				self.recorder.record( key, srv )
+			## Same reply as last time, nothing changed to show
+			## but maybe the trend column
+			if refresh and srv.digest == digest:
+				if sampled and self.showTrend and key in self.servers:
+					self.srvlst.updateItem( key, srv )
+				return
 			self.settings.addGametype( srv.gametype )
 			self.settings.addMod( srv.mod )
 
-			## Update progress bar
-			self.processedServers += 1
-			self.printProcessStatus()
+			## Friends are looked for on listed and rejected
+			## servers alike, they can only be found with the players
+			if twoPhase and self.friendLabels and srv.clients > srv.bots:
+				self.detailServers( [ srv ] )
+			self.indexPlayers( key, srv )
 
-		except ConnectionError:
-			## probably timed out, forget it
-			self.processedServers += 1
-			self.printProcessStatus()
+			## Decide once whether we list it, the filter may have
+			## changed while we were parsing. Whoever moves a server
+			## into self.servers under the lock adds its row
+			with self.rejectLock:
+				shown = accepted or filt is not self.filter
+				if not shown:
+					add = False
+					if not refresh:
+						self.rejected[ key ] = srv
+				elif refresh:
+					add = self.rejected.pop( key, None ) is not None
+				else:
+					add = True
+				if add:
+					self.servers[ key ] = srv
 
-		curses.doupdate()#}}}
+			if add:
+				if self.settings.getPing() and srv.ping is None: srv.getPing()
+				self.addServer( key, srv )
+			elif refresh:
+				self.updateServer( key, srv )
+			if not refresh:
+				## Update progress bar
+				self.processedServers += 1
+				self.printProcessStatus()
+			## Rules may test the ping, so only once it was measured
+			self.observeServer( key, srv )
+
+		except ConnectionError:
+			## probably timed out, forget it unless
+			## the scheduler will try again
+			if not retry and not refresh:
+				self.processedServers += 1
+				self.printProcessStatus()#}}}
 
 	def processServers(self):#{{{
 		"""
-		Spawn a process thread for every found server
+		Spawn a process thread for every found server,
+		as many at a time as the scheduler allows
+		"""
+		threads = []
+		while not self.stop:
+			key = self.scheduler.get()
+			if key is None:
+				break
+			thread = threading.Thread(target=self.processServer, args=[key])
+			thread.start()
+			threads.append( thread )
+
+		for thread in threads:
+			thread.join()
+		self.negcache.save()
+		if not self.stop:
+			self.printScanReport()
+			self.refreshServers()#}}}
+
+	def refreshServers(self):#{{{
+		"""
+		Keep serving the servers found by the scan until
+		stopped: details asked for are fetched and with
+		auto refresh each server is polled on its own
+		interval, those whose player count changes more often
 		"""
-		for ip in self.serverips:
-			if self.stop:
+		refresh = scheduler.Scheduler( [], self.window, int( self.settings.getPerHost() ), attempts=1,
+				keep_open=True )
+		self.refreshing = self.settings.getAutoRefresh()
+		if self.refreshing:
+			with self.rejectLock:
+				found = self.servers.items() + self.rejected.items()
+			for key, srv in found:
+				if self.isWatched( key ):
+					continue
+				refresh.add( key, priority=self.PRIO_OTHER, delay=self.intervals.next( key, srv.clients ) )
+		self.scheduler = refresh
+		## stopServers() may have closed the scan scheduler
+		## before this one was set
+		if self.stop:
+			return
+
+		while not self.stop:
+			key = refresh.get()
+			if key is None:
 				break
-			if threading.activeCount() > 5:
-				time.sleep(0.1)
-			thread = threading.Thread(target=self.processServer, args=[ip])
-			thread.start()#}}}
+			threading.Thread( target=self.processServer, args=[key] ).start()#}}}
+
+	def updateServer(self, key, srv):#{{{
+		"""
+		Show the new state of a refreshed server, the row
+		of a listed one is updated in place
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object, already updated
+		"""
+		if key in self.servers:
+			self.srvlst.updateItem( key, srv, lambda: self.getPlayerNames( srv ) )#}}}
+
+	def addServer(self, key, srv):#{{{
+		"""
+		Show a server, its player list is only
+		built once the item is expanded
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		"""
+		self.servers[ key ] = srv
+		self.srvlst.addItem( srv, lambda: self.getPlayerNames( srv ), key )#}}}
+
+	def indexPlayers(self, key, srv):#{{{
+		"""
+		Index the players of a polled server, listed or not,
+		while we have friends to look for
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		"""
+		if self.friendLabels and srv.detailed:
+			self.playerIndex.update( key, [ p.name for p in srv.players ] )
+			self.updateFriends()#}}}
+
+	def getPlayerNames(self, srv):#{{{
+		"""
+		Return the player names of a server for its expanded
+		row. A server only seen through getinfo has none yet,
+		the scheduler is asked for its full status and the
+		row is filled in by processServer() when it comes
+
+		arguments:
+		srv -- the server object
+		"""
+		if not srv.detailed:
+			self.detailServers( [ srv ] )
+			return []
+		return [ p.name for p in srv.players ]#}}}
+
+	def detailServers(self, servers):#{{{
+		"""
+		Have the scheduler get the full status of servers
+		before anything else, within its window and limit
+		per host. processServer() asks for a getstatus for
+		those it is handed
+
+		arguments:
+		servers -- list of server objects
+		"""
+		queue = self.scheduler
+		if queue is None:
+			return
+		keys = [ srv.key for srv in servers
+				if not srv.detailed and self.detailing.get( srv.key ) is not queue
+				and not self.isWatched( srv.key ) ]
+		for key in keys:
+			## Requests left in a finished scan are made again
+			self.detailing[ key ] = queue
+		## Servers in flight are asked again on a later redraw
+		queued = queue.prioritize( keys, self.PRIO_FIRST, add=True )
+		for key in keys:
+			if key not in queued:
+				self.detailing.pop( key, None )#}}}
+
+	def prioritizeVisible(self):#{{{
+		"""
+		Have the scanner ask the servers coming on screen
+		first, when refreshing they are polled right away.
+		Rows that stay on screen keep their intervals
+		"""
+		if self.scheduler is not None and self.focusedWidget == self.srvlst:
+			keys = set( srv.key for srv in self.srvlst.getVisibleItems() )
+			self.scheduler.prioritize( keys - self.visibleKeys, self.PRIO_FIRST )
+			self.visibleKeys = keys#}}}
+
+	def detailVisible(self):#{{{
+		"""
+		In two phase scans get the full status of the
+		servers on screen
+		"""
+		if self.settings.getTwoPhase() and self.focusedWidget == self.srvlst:
+			self.detailServers( self.srvlst.getVisibleItems() )#}}}
+
+	def toggleWatch(self):#{{{
+		"""
+		Start watching the selected server, or stop if
+		it is the one watched. Only one server is watched,
+		the watch moves from any other to the selected one
+		"""
+		listItem = self.srvlst.getSelectedListItem()
+		if listItem is None:
+			return
+		srv = listItem.item
+		key = srv.key
+		old = self.unwatch()
+		if old == key:
+			self.status.setMessage( 'Stopped watching %s' % srv.name2 )
+			return
+		stop = threading.Event()
+		self.watched = ( key, stop )
+		## The watch thread polls it from now on
+		if self.scheduler is not None:
+			self.scheduler.remove( key )
+		threading.Thread( target=self.watchServer, args=[key, srv, stop] ).start()
+		if old is not None and old in self.servers:
+			self.status.setMessage( 'Watching %s instead of %s' % ( srv.name2, self.servers[ old ].name2 ) )
+		else:
+			self.status.setMessage( 'Watching %s' % srv.name2 )#}}}
+
+	def unwatch(self):#{{{
+		"""
+		Stop watching, return the key of the server
+		watched or None
+		"""
+		if self.watched is None:
+			return None
+		key, stop = self.watched
+		stop.set()
+		self.watched = None
+		## Back to being refreshed with the others
+		if self.refreshing and self.scheduler is not None and key in self.servers:
+			self.scheduler.add( key, priority=self.PRIO_OTHER )
+		return key#}}}
+
+	def isWatched(self, key):#{{{
+		"""
+		Return whether a server is watched, it is then
+		polled by watchServer() instead of the scheduler
+
+		arguments:
+		key -- packed address of server
+		"""
+		watched = self.watched
+		return watched is not None and watched[0] == key#}}}
+
+	def watchServer(self, key, srv, stop):#{{{
+		"""
+		Thread polling a watched server every POLL_INTERVAL
+		seconds until stopped. Its row and players are only
+		parsed and updated when the reply differs from the
+		last one, see Server.digest. The scheduler leaves it
+		alone while watched, a query of it still in flight is
+		waited for so only one thread parses into it
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		stop -- threading.Event ending the watch
+		"""
+		queue = self.scheduler
+		while queue is not None and key in queue.running and not stop.is_set():
+			stop.wait( 0.05 )
+		while not stop.is_set():
+			digest = srv.digest
+			try:
+				srv.getstatus( pool=self.pool, timeout=self.POLL_INTERVAL, retries=1 )
+			except ConnectionError:
+				pass
+			else:
+				if srv.digest != digest and not stop.is_set():
+					self.observeServer( key, srv )
+					self.indexPlayers( key, srv )
+					self.updateServer( key, srv )
+			stop.wait( self.POLL_INTERVAL )#}}}
+
+	def toggleAutoJoin(self):#{{{
+		"""
+		Queue the selected server for auto-join, or take
+		it off the queue
+		"""
+		listItem = self.srvlst.getSelectedListItem()
+		if listItem is None:
+			return
+		srv = listItem.item
+		key = srv.key
+		if key in self.autojoin:
+			self.autojoin.pop( key )[1].set()
+			self.status.setMessage( 'Stopped auto-joining %s' % srv.name2 )
+			return
+		self.startAutoJoin( srv )
+		self.status.setMessage( 'Joining %s when a slot opens' % srv.name2 )#}}}
+
+	def startAutoJoin(self, srv):#{{{
+		"""
+		Start polling a server for a free slot
+
+		arguments:
+		srv -- the server object
+		"""
+		stop = threading.Event()
+		self.autojoin[ srv.key ] = ( srv, stop )
+		threading.Thread( target=self.autoJoin, args=[srv, stop] ).start()#}}}
+
+	def autoJoin(self, srv, stop):#{{{
+		"""
+		Thread polling a server with getinfo every POLL_INTERVAL
+		seconds until it has a free slot, then have the main
+		loop launch it. The listed server object is left to the
+		scanner, the polls parse into a copy of it
+
+		arguments:
+		srv -- the server object
+		stop -- threading.Event ending the polling
+		"""
+		probe = server.Server( srv.host, srv.port, key=srv.key )
+		while not stop.is_set():
+			try:
+				probe.getinfo( pool=self.pool, timeout=self.POLL_INTERVAL, retries=1 )
+			except ConnectionError:
+				pass
+			else:
+				if probe.maxclients and probe.clients < probe.maxclients and not stop.is_set():
+					self.joining = srv
+					return
+			stop.wait( self.POLL_INTERVAL )#}}}
+
+	def observeServer(self, key, srv):#{{{
+		"""
+		Look at a freshly polled server for alerts
+		and player events
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		"""
+		self.checkRules( key, srv )
+		self.events.update( key, srv )#}}}
+
+	def showPlayerEvent(self, event):#{{{
+		"""
+		Subscriber showing player events of friends
+		and of the watched server in the status bar
+
+		arguments:
+		event -- net.events.PlayerEvent
+		"""
+		watched = self.isWatched( event.key )
+		names = set( server.normalize_name( name ) for name in self.friendLabels )
+		if watched or server.normalize_name( event.name ) in names or \
+				( event.old is not None and server.normalize_name( event.old ) in names ):
+			self.status.setMessage( str( event ) )#}}}
+
+	def openPlayerLog(self):#{{{
+		"""
+		Log player events to the file in the settings,
+		closing the log used so far
+		"""
+		if self.eventLog is not None:
+			self.events.unsubscribe( self.eventLog )
+			self.eventLog.close()
+			self.eventLog = None
+		path = self.settings.getPlayerLog()
+		if not path:
+			return
+		try:
+			self.eventLog = events.EventLog( path )
+		except IOError, e:
+			self.status.setMessage( 'Cannot open player log: %s' % e )
+			return
+		self.events.subscribe( self.eventLog )#}}}
+
+	def openRecorder(self):#{{{
+		"""
+		Start or stop recording the population of polled
+		servers, as the settings say
+		"""
+		if self.recorder is not None and not self.settings.getRecord():
+			self.recorder.close()
+			self.recorder = None
+		elif self.recorder is None and self.settings.getRecord():
+			try:
+				self.recorder = recorder.Recorder( self.settings.recorddb )
+			except sqlite3.Error, e:
+				self.status.setMessage( 'Cannot open %s: %s' % ( self.settings.recorddb, e ) )#}}}
+
+	def checkRules(self, key, srv):#{{{
+		"""
+		Run the alert rules on a freshly polled server, showing
+		a message and running the command of those it started
+		matching
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		"""
+		for rule in self.rules.check( key, srv ):
+			self.status.setMessage( '%s: %s (%s)' % ( rule.name, srv.name2, srv.address() ) )
+			try:
+				rule.run( srv )
+			except ( OSError, ValueError, KeyError, IndexError ), e:
+				self.status.setMessage( 'Rule %s failed: %s' % ( rule.name, e ) )#}}}
 
 	def stopServers(self): ## {{{
 		"""
-		Signals threads to stop and waits until all threads stopped
+		Signals threads to stop and waits until all threads stopped,
+		daemon threads like the recorder's keep running
 		"""
 		self.stop = True
-		while threading.activeCount() > 1:
+		self.unwatch()
+		for srv, stop in self.autojoin.values():
+			stop.set()
+		self.autojoin = {}
+		if self.scheduler is not None:
+			self.scheduler.close()
+		current = threading.currentThread()
+		while [ t for t in threading.enumerate() if t is not current and not t.daemon ]:
 			time.sleep(0.2)
 		## }}}
 
@@ -146,15 +663,47 @@ class cursow(object):
 		if self.totalServers == 0:
 			return
 		w = self.status.width - 1
-		msg = '%d/%d' % ( self.processedServers, self.totalServers )
+		msg = '%d/%d w:%d loss:%d%% %dq/s' % ( self.processedServers, self.totalServers, self.window.get_window(),
+				100 * self.window.get_loss_rate(), self.window.get_rate() )
 		w2 = int( float( w-len(msg)-3 ) * self.processedServers / self.totalServers )
 		msg = msg + ' %' + ('='*w2).ljust( w-len(msg)-3 , '-') + '%'
 		self.status.setMessage( msg )#}}}
 
+	def printScanReport( self ):#{{{
+		"""
+		Helper method to sum up a finished scan in the status,
+		the servers cut off by the deadline are listed in a file
+		"""
+		answered = len( self.servers ) + len( self.rejected )
+		msg = '%d/%d servers answered in %.1fs' % ( answered, self.totalServers, time.time() - self.started )
+		cutoff = sorted( address.to_string( key ) for key in self.scheduler.cutoff )
+		if cutoff:
+			try:
+				with open( self.settings.cutoff, 'w' ) as f:
+					f.write( ''.join( '%s\n' % addr for addr in cutoff ) )
+				msg += ', %d cut off by the deadline (see %s)' % ( len( cutoff ), self.settings.cutoff )
+			except IOError:
+				msg += ', %d cut off by the deadline: %s' % ( len( cutoff ), ' '.join( cutoff[:3] ) )
+		if self.skippedServers:
+			msg += ', %d dead skipped' % self.skippedServers
+		self.status.setMessage( msg )#}}}
+
 	##########
 	# Screen object helpers
 	##########
 
+	def drawChanges( self ):#{{{
+		"""
+		Draw the status message and friends tab, other
+		threads only change them and leave drawing to the
+		main loop
+		"""
+		if self.friendsChanged and self.friendMenu.visible:
+			self.friendsChanged = False
+			self.friendMenu.display()
+		if self.status.dirty:
+			self.status.display()#}}}
+
 	def initSrvlst( self ):#{{{
 		"""
 		Create status container and srvlst inside it
@@ -171,7 +720,7 @@ class cursow(object):
 		self.columnDisps = [
 				lambda x: 'X' if x.instagib else ' ', 
 				lambda x: 'X' if x.password else ' ',
-				lambda x: '%d' % x.ping,
+				lambda x: '%d' % x.ping if x.ping is not None else '',
 				lambda x: '%s/%s' % (x.clients, x.maxclients),
 				lambda x: x.map,
 				lambda x: x.mod,
@@ -180,14 +729,22 @@ class cursow(object):
 		self.columnSorts = [
 				lambda x: 1 if x.instagib else 0, 
 				lambda x: 1 if x.password else 0,
-				lambda x: x.ping,
+				lambda x: x.ping if x.ping is not None else float( 'inf' ),
 				lambda x: x.clients,
 				lambda x: x.map.lower(),
 				lambda x: x.mod.lower(),
 				lambda x: x.gametype.lower(),
-				lambda x: x.name2.lower() ]
+				lambda x: server.normalize_name( x.name ) ]
 		self.columnWidths = [ 1, 1, 3, 5, -1, -1, -1, -2 ]
 		totalwidth = 5
+
+		## Player counts of the last polls, sorted by growth
+		self.showTrend = self.settings.getTrendColumn()
+		if self.showTrend:
+			self.columnNames.insert( 4, 'trend' )
+			self.columnDisps.insert( 4, lambda x: self.history.sparkline( x.key, x.maxclients ) )
+			self.columnSorts.insert( 4, lambda x: self.history.trend( x.key ) )
+			self.columnWidths.insert( 4, self.history.size )
 		
 		for n in range( len(self.columnNames) ):
 			w = self.columnWidths[n]
@@ -219,9 +776,15 @@ class cursow(object):
 		self.setFilters()
 
 		## Make Friends List
-		# TODO
 		self.friendMenu = self.tabcon.addWidget( 'Friends', cui.menu )
-		self.friendMenu.addLabel( 'Keyboard Shortcuts', just='center' )
+		self.friendMenu.addLabel( 'Friends', just='center' )
+		self.friendInput = self.friendMenu.addInputBox( lambda: '', self.addFriend, label = 'Add Friend' )
+		self.unfriendInput = self.friendMenu.addInputBox( lambda: '', self.delFriend, label = 'Remove Friend' )
+		self.friendMenu.addLabel( 'Playing', mode=curses.A_REVERSE )
+		self.friendLabels = {}
+		for name in self.settings.getFriends():
+			self.friendLabels[ name ] = self.friendMenu.addLabel( name )
+		self.updateFriends()
 
 		## Make Settings List
 		self.colMenu = self.tabcon.addWidget( 'Settings', cui.menu )
@@ -231,6 +794,18 @@ class cursow(object):
 		self.colMenu.addLabel( 'Warsow 1.0', mode=curses.A_REVERSE )
 		self.colMenu.addInputBox( lambda: self.settings.getOpt( 'Warsow 1.0', 'Path' ), lambda x: self.settings.setOpt( 'Warsow 1.0', 'Path', x ), label = 'Path' )
 		self.colMenu.addInputBox( lambda: self.settings.getOpt( 'Warsow 1.0', 'Args' ), lambda x: self.settings.setOpt( 'Warsow 1.0', 'Args', x ), label = 'Args' )
+		self.colMenu.addLabel( 'Scanning', mode=curses.A_REVERSE )
+		self.colMenu.addListBox( "Queries per Host", self.settings.getPerHost, self.settings.incPerHost )
+		self.colMenu.addToggle( "Hedge Slow Queries", self.settings.getHedge, self.settings.setHedge )
+		self.colMenu.addListBox( "Scan Deadline", self.settings.getDeadline, self.settings.incDeadline )
+		self.colMenu.addToggle( "Skip Dead Servers", self.settings.getSkipDead, self.settings.setSkipDead )
+		self.colMenu.addToggle( "Two Phase Scan", self.settings.getTwoPhase, self.settings.setTwoPhase )
+		self.colMenu.addToggle( "Auto Refresh", self.settings.getAutoRefresh, self.settings.setAutoRefresh )
+		self.colMenu.addInputBox( self.settings.getPlayerLog, self.settings.setPlayerLog, label = 'Player Log' )
+		self.colMenu.addLabel( 'Display', mode=curses.A_REVERSE )
+		self.colMenu.addToggle( "Trend Column", self.settings.getTrendColumn, self.settings.setTrendColumn )
+		self.colMenu.addLabel( 'History', mode=curses.A_REVERSE )
+		self.colMenu.addToggle( "Record Population", self.settings.getRecord, self.settings.setRecord )
 
 		## Make Help menu
 		# TODO - make this read from cui/common
@@ -246,6 +821,8 @@ class cursow(object):
 		self.helpMenu.addLabel( 'Launch Server: <Enter>' )
 		self.helpMenu.addLabel( 'Add to Favorites: f' )
 		self.helpMenu.addLabel( 'Remove from Favorites: F' )
+		self.helpMenu.addLabel( 'Watch Server: v' )
+		self.helpMenu.addLabel( 'Auto-join Server: J' )
 		self.helpMenu.addLabel( 'Reverse Sort: r,R' )
 		self.helpMenu.addLabel( 'Navigation', mode=curses.A_REVERSE )
 		self.helpMenu.addLabel( 'Up: w,u,k,<UP>' )
@@ -259,6 +836,19 @@ class cursow(object):
 
 		#}}}
 
+	def initRules( self ):#{{{
+		"""
+		Compile the alert rules of the settings file, rules
+		that don't compile are left out
+		"""
+		compiled = []
+		for name, expression, command in self.settings.getRules():
+			try:
+				compiled.append( rules.Rule( name, expression, command ) )
+			except rules.RuleError, e:
+				self.status.setMessage( 'Bad rule %s: %s' % ( name, e ) )
+		self.rules = rules.RuleSet( compiled )#}}}
+
 	def resize( self ):#{{{
 		"""
 		Resize main containers, the containers
@@ -313,18 +903,30 @@ class cursow(object):
 		else:
 			instagib = lambda x: True
 
-		if self.settings.getGametype() == 'all':
+		gametypename = self.settings.getGametype()
+		if gametypename == 'all':
 			gametype = lambda x: True
 		else:
-			gametype = lambda x: x.gametype == self.settings.getGametype()
+			gametype = lambda x: x.gametype == gametypename
 
-		if self.settings.getMod() == 'all':
+		modname = self.settings.getMod()
+		if modname == 'all':
 			mod = lambda x: True
 		else:
-			mod = lambda x: x.mod == self.settings.getMod()
+			mod = lambda x: x.mod == modname
 
 		filt = lambda x: full(x) and empty(x) and bots(x) and password(x) and instagib(x) and gametype(x) and mod(x)
-		self.srvlst.setFilter( filt )#}}}
+
+		## Servers rejected by the scanner may match now
+		with self.rejectLock:
+			self.filter = filt
+			promoted = [ (key, srv) for key, srv in self.rejected.items() if filt( srv ) ]
+			for key, srv in promoted:
+				del self.rejected[ key ]
+
+		self.srvlst.setFilter( filt )
+		for key, srv in promoted:
+			self.addServer( key, srv )#}}}
 
 	##########
 	# Input Handling
@@ -349,6 +951,12 @@ class cursow(object):
 			elif key in cui.KEY_DELFAV:
 				self.delFav()
 
+			elif key in cui.KEY_WATCH:
+				self.toggleWatch()
+
+			elif key in cui.KEY_AUTOJOIN:
+				self.toggleAutoJoin()
+
 			elif key in cui.KEY_LEFT or key in cui.KEY_TABPREV:
 				self.navColumn( -1 )
 
@@ -386,6 +994,8 @@ class cursow(object):
 		"""
 		self.oldGame = self.settings.getGame()
 		self.oldFavs = self.settings.getShowFavorites()
+		self.oldLog = self.settings.getPlayerLog()
+		self.oldTrend = self.settings.getTrendColumn()
 
 		self.srvlst.pause()
 		self.tabcon.show()
@@ -400,6 +1010,14 @@ class cursow(object):
 		if self.oldGame != self.settings.getGame() or self.oldFavs != self.settings.getShowFavorites():
 			self.startQuery()
 
+		if self.oldLog != self.settings.getPlayerLog():
+			self.openPlayerLog()
+		self.openRecorder()
+		if self.oldTrend != self.settings.getTrendColumn():
+			for title in self.columnNames:
+				self.srvlst.delColumn( title )
+			self.initColumns()
+
 		self.tabcon.hide()
 		self.setFilters()
 		self.focusedWidget = self.srvlst
@@ -421,8 +1039,72 @@ class cursow(object):
 		srv = self.srvlst.getSelectedItem()
 		self.settings.delFav( '%s:%d' % ( srv.host , srv.port ) )#}}}
 
-	def launch(self): ## {{{
-		server = self.srvlst.getSelectedItem()
+	def addFriend(self, name):#{{{
+		"""
+		Add a player to the friends list and show where they are playing
+
+		arguments:
+		name -- player name to add
+		"""
+		self.friendInput.message = ''
+		name = name.strip()
+		if not name or name in self.friendLabels:
+			return
+		with self.rejectLock:
+			found = self.servers.items() + self.rejected.items()
+		## Players are only indexed while we have friends
+		if not self.friendLabels:
+			for key, srv in found:
+				if srv.detailed:
+					self.playerIndex.update( key, [ p.name for p in srv.players ] )
+		self.settings.addFriend( name )
+		self.friendLabels[ name ] = self.friendMenu.addLabel( name )
+		self.updateFriends()
+		## Players of two phase scans are still unknown
+		self.detailServers( [ srv for key, srv in found if srv.clients > srv.bots ] )#}}}
+
+	def delFriend(self, name):#{{{
+		"""
+		Remove a player from the friends list
+
+		arguments:
+		name -- player name to remove
+		"""
+		self.unfriendInput.message = ''
+		name = name.strip()
+		if name not in self.friendLabels:
+			return
+		self.settings.delFriend( name )
+		self.friendMenu.delOption( self.friendLabels.pop( name ) )
+		## Without friends there is no need to index players
+		if not self.friendLabels:
+			self.playerIndex.clear()
+		self.updateFriends()#}}}
+
+	def updateFriends(self):#{{{
+		"""
+		Look up every friend in the player index and
+		update the friends tab with where they are playing,
+		the main loop draws it
+		"""
+		for name, label in self.friendLabels.items():
+			found = []
+			for key in sorted( self.playerIndex.lookup( name ) ):
+				srv = self.servers.get( key ) or self.rejected.get( key )
+				ip = address.to_string( key )
+				found.append( '%s (%s)' % ( srv.name2, ip ) if srv else ip )
+			label.message = '%s: %s' % ( name, ', '.join( found ) if found else '-' )
+		self.friendsChanged = True#}}}
+
+	def launch(self, server=None): ## {{{
+		"""
+		Start the game connecting to a server
+
+		arguments:
+		server -- the server object (default = the selected one)
+		"""
+		if server is None:
+			server = self.srvlst.getSelectedItem()
 		path, args = self.settings.getPath(), self.settings.getArgs()
 
 		if sys.platform == 'cygwin':
@@ -454,6 +1136,12 @@ class cursow(object):
 	def quit(self): ## {{{
 		self.settings.writeCfg()
 		self.stopServers()
+		self.negcache.save()
+		if self.eventLog is not None:
+			self.eventLog.close()
+		if self.recorder is not None:
+			self.recorder.close()
+		self.pool.close()
 		## }}}
 
 if __name__ == '__main__':
@@ -1,5 +1,5 @@
 #!/usr/bin/env python2
-__all__ = ['connection', 'server', 'wsw']
+__all__ = ['address', 'connection', 'events', 'friends', 'history', 'negcache', 'recorder', 'rules', 'scheduler', 'server', 'wsw']
 
 class Error(Exception):
 	pass
@@ -0,0 +1,32 @@
+#!/usr/bin/env python2
+import socket as SO, struct
+
+# servers are keyed by their address packed the way master
+# servers send it: 4 bytes of ip and 2 bytes of big endian
+# port. These hash and compare cheaply and are only turned
+# into "ip:port" strings for display.
+PORT = struct.Struct('!H')
+
+def pack(host, port): ##{{{
+	"""
+	Pack a host and port into a 6 byte address key.
+	Host names are resolved.
+	"""
+	return SO.inet_aton(SO.gethostbyname(host)) + PORT.pack(port) ##}}}
+
+def unpack(key): ##{{{
+	"""Return the (ip, port) pair of an address key."""
+	return (SO.inet_ntoa(key[:4]), PORT.unpack(key[4:])[0]) ##}}}
+
+def host(key): ##{{{
+	"""Return the packed ip of an address key."""
+	return key[:4] ##}}}
+
+def to_string(key): ##{{{
+	"""Format an address key as "ip:port"."""
+	return "%s:%d" % unpack(key) ##}}}
+
+def from_string(address): ##{{{
+	"""Parse a "host:port" string into an address key."""
+	host, port = address.rsplit(":", 1)
+	return pack(host, int(port)) ##}}}
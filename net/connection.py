@@ -1,6 +1,90 @@
 #!/usr/bin/env python2
 from net import Error, ConnectionError
-import socket as SO
+import socket as SO, threading
+
+class SocketPool(object): ##{{{
+    """
+    A bounded set of UDP sockets shared by connections.
+
+    Connections borrow a socket for as long as they live
+    and connect() it to their server; when released it
+    is drained and kept for the next one. At most "size"
+    sockets are ever open, acquire() blocks until one is
+    free, so a full scan uses a small constant number of
+    file descriptors.
+    """
+
+    def __init__(self, size=16): ##{{{
+        """
+        Create an empty pool allowing "size" open sockets.
+        """
+        assert size >= 1
+        self.size = size
+        self.idle = []
+        # fd accounting: sockets open right now, lent out
+        # right now and created over the pool's lifetime
+        self.opened = 0
+        self.in_use = 0
+        self.created = 0
+        self.closed = False
+        self.condition = threading.Condition() ##}}}
+
+    def acquire(self): ##{{{
+        """
+        Borrow a socket, waiting for one to be released
+        if all "size" of them are in use.
+        """
+        with self.condition:
+            while not self.closed and not self.idle and self.opened >= self.size:
+                self.condition.wait()
+            if self.closed:
+                raise ConnectionError("Socket pool is closed")
+            if self.idle:
+                sock = self.idle.pop()
+            else:
+                sock = SO.socket(SO.AF_INET, SO.SOCK_DGRAM)
+                self.opened += 1
+                self.created += 1
+            self.in_use += 1
+            return sock ##}}}
+
+    def release(self, sock): ##{{{
+        """
+        Give back a borrowed socket. Datagrams still queued
+        from its last server are dropped first, so they
+        don't show up as replies of the next one.
+        """
+        sock.setblocking(0)
+        try:
+            while True:
+                sock.recv(65536)
+        except SO.error:
+            pass
+
+        with self.condition:
+            self.in_use -= 1
+            if self.closed:
+                sock.close()
+                self.opened -= 1
+            else:
+                self.idle.append(sock)
+            self.condition.notify() ##}}}
+
+    def close(self): ##{{{
+        """
+        Close all idle sockets; sockets still lent out are
+        closed as they come back. Waiting acquire() calls
+        fail with ConnectionError.
+        """
+        with self.condition:
+            self.closed = True
+            for sock in self.idle:
+                sock.close()
+            self.opened -= len(self.idle)
+            self.idle = []
+            self.condition.notify_all() ##}}}
+
+    ##}}}
 
 class Connection(object): ##{{{
     """
@@ -16,7 +100,7 @@ class Connection(object): ##{{{
     PREFIX_LENGTH = 4
     PACKET_PREFIX = "\xff" * PREFIX_LENGTH
 
-    def __init__(self, host, port, size=8192, timeout=1.0, retries=5): ##{{{
+    def __init__(self, host, port, size=8192, timeout=1.0, retries=5, pool=None): ##{{{
         """
         Create a pseudo-connection to "host" and "port"; we
         try to give UDP communication a semblance of sanity.
@@ -24,23 +108,38 @@ class Connection(object): ##{{{
         The internal UDP packet buffer will be "size" bytes,
         we'll wait "timeout" seconds for each response, and
         we'll retry commands "retries" times before failing.
+        If a SocketPool is given the socket is borrowed from
+        it; either way, close() the connection when done.
         """
         # we neither want to deal with blocking nor with
         # timeouts that are plain silly in 2009...
         assert 0.1 <= timeout <= 4.0
         assert 4096 <= size <= 65536
         assert 1 <= retries <= 10
-        self.socket = SO.socket(SO.AF_INET, SO.SOCK_DGRAM)
-        # for SOCK_DGRAM connect() slips a default address
-        # into each datagram; furthermore only data from the
-        # "connected" address is delivered back; pretty neat
-        self.socket.connect((host, port))
-        self.socket.settimeout(timeout)
+        self.pool = pool
+        if pool is not None:
+            self.socket = pool.acquire()
+        else:
+            self.socket = SO.socket(SO.AF_INET, SO.SOCK_DGRAM)
+        try:
+            # for SOCK_DGRAM connect() slips a default address
+            # into each datagram; furthermore only data from the
+            # "connected" address is delivered back; pretty neat
+            self.socket.connect((host, port))
+            self.socket.settimeout(timeout)
+        except:
+            self.close()
+            raise
         self.host = host
         self.port = port
         self.size = size
         self.timeout = timeout
-        self.retries = retries ##}}}
+        self.retries = retries
+        # packets are received into this buffer and looked
+        # at through the view; bytes are only copied out for
+        # the parts of a response we actually keep
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer) ##}}}
 
     def send(self, data): ##{{{
         """
@@ -48,24 +147,36 @@ class Connection(object): ##{{{
         """
         self.socket.send("%s%s" % (Connection.PACKET_PREFIX, data)) ##}}}
 
-    def receive(self): ##{{{
+    def receive_into(self): ##{{{
         """
-        Receive a properly formatted packet and return the
-        unpacked (type, data) response pair. Note that one
-        packet will be read, not multiple; use receive_all
-        to get all packets up to a timeout.
+        Receive a packet into the connection's buffer and
+        check its header without copying anything. Return
+        the packet length and the offset of the newline
+        ending the response type.
         """
-        packet = self.socket.recv(self.size)
+        length = self.socket.recv_into(self.buffer)
 
-        if packet.find(Connection.PACKET_PREFIX) != 0:
+        prefix = Connection.PREFIX_LENGTH
+        if length < prefix or self.view[:prefix] != Connection.PACKET_PREFIX:
             raise ConnectionError("Malformed packet")
 
-        first_line_length = packet.find("\n")
+        first_line_length = self.buffer.find("\n", prefix, length)
         if first_line_length == -1:
             raise ConnectionError("Malformed packet")
 
-        response_type = packet[Connection.PREFIX_LENGTH:first_line_length]
-        response_data = packet[first_line_length+1:]
+        return (length, first_line_length) ##}}}
+
+    def receive(self): ##{{{
+        """
+        Receive a properly formatted packet and return the
+        unpacked (type, data) response pair. Note that one
+        packet will be read, not multiple; use receive_all
+        to get all packets up to a timeout.
+        """
+        length, first_line_length = self.receive_into()
+
+        response_type = self.view[Connection.PREFIX_LENGTH:first_line_length].tobytes()
+        response_data = self.view[first_line_length+1:length].tobytes()
 
         return (response_type, response_data) ##}}}
 
@@ -86,39 +197,67 @@ class Connection(object): ##{{{
         if so merge the data from all packets. Return
         the merged (type, data) response pair.
         """
-        packets = []
+        status = None
+        data = []
 
         try:
             while True:
-                packet = self.receive()
-                packets.append(packet)
+                length, first_line_length = self.receive_into()
+                if status is None:
+                    status = self.view[Connection.PREFIX_LENGTH:first_line_length].tobytes()
+                else:
+                    assert self.view[Connection.PREFIX_LENGTH:first_line_length] == status
+                data.append(self.view[first_line_length+1:length].tobytes())
         except SO.timeout:
             # we timed out, so we'll assume that the
             # sequence of packets has ended; not sure
             # if this is a good idea...
             pass
 
-        assert len(packets) > 0
-        status, data = packets[0]
-        for packet in packets[1:]:
-            assert status == packet[0]
-            data += packet[1]
+        assert status is not None
+        return (status, "".join(data)) ##}}}
 
-        return (status, data) ##}}}
+    def receive_hedged(self, cmd, hedge): ##{{{
+        """
+        Receive one packet like receive(), but if nothing
+        arrived after "hedge" seconds send "cmd" again and
+        keep waiting for whichever reply comes first. The
+        socket only delivers packets from our server and we
+        return on the first one; a late duplicate is left
+        behind and dropped when the socket is released.
+        """
+        self.socket.settimeout(hedge)
+        try:
+            return self.receive()
+        except SO.timeout:
+            self.send(cmd)
+            self.socket.settimeout(max(self.timeout - hedge, 0.01))
+            return self.receive()
+        finally:
+            self.socket.settimeout(self.timeout) ##}}}
 
-    def command(self, cmd): ##{{{
+    def command(self, cmd, multi=True, hedge=None): ##{{{
         """
         Execute given command and return (type, data)
         response pair. Commands will be retried for a
         number of times. (All response packets will be
-        read and merged using receive_all.)
+        read and merged using receive_all; unless "multi"
+        is False, then only the first packet is read and
+        we don't sit out a timeout waiting for more. In
+        that case a "hedge" delay may be given too, see
+        receive_hedged.)
         """
         retries = self.retries
         response = None
         while retries > 0:
             self.send(cmd)
             try:
-                response = self.receive_all()
+                if multi:
+                    response = self.receive_all()
+                elif hedge is not None and hedge < self.timeout:
+                    response = self.receive_hedged(cmd, hedge)
+                else:
+                    response = self.receive()
             except Exception:
                 # TODO: really catch Exception here? no
                 # SO.error or something?
@@ -148,8 +287,23 @@ class Connection(object): ##{{{
                 return response
         raise ConnectionError("No response after %d attempts." % self.retries) ##}}}
 
-def close(self): ##{{{
-        """Close connection."""
-        self.socket.close() ##}}}
+    def close(self): ##{{{
+        """
+        Close connection, giving the socket back to the
+        pool it came from.
+        """
+        if self.socket is None:
+            return
+        if self.pool is not None:
+            self.pool.release(self.socket)
+        else:
+            self.socket.close()
+        self.socket = None ##}}}
+
+    def __enter__(self): ##{{{
+        return self ##}}}
+
+    def __exit__(self, *exc_info): ##{{{
+        self.close() ##}}}
 
     ##}}}
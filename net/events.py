@@ -0,0 +1,163 @@
+#!/usr/bin/env python2
+import address, collections, json, server, threading, time
+
+JOIN = 'join'
+LEAVE = 'leave'
+RENAME = 'rename'
+
+class PlayerEvent(object): ##{{{
+	"""Record of a player joining, leaving or renaming."""
+
+	__slots__ = ('time', 'kind', 'key', 'server', 'name', 'old')
+
+	def __init__(self, kind, key, server, name, old=None): ##{{{
+		"""
+		Create an event happening now
+
+		arguments:
+		kind -- JOIN, LEAVE or RENAME
+		key -- packed address of the server
+		server -- server name, without colors
+		name -- player name
+		old -- former name of a renamed player
+		"""
+		self.time = time.time()
+		self.kind = kind
+		self.key = key
+		self.server = server
+		self.name = name
+		self.old = old ##}}}
+
+	def to_dict(self): ##{{{
+		"""Dictionary of the event, as logged."""
+		event = {'time': round(self.time, 3), 'event': self.kind,
+				'address': address.to_string(self.key), 'server': self.server,
+				'name': self.name}
+		if self.old is not None:
+			event['old'] = self.old
+		return event ##}}}
+
+	def __str__(self): ##{{{
+		"""Short description for the status bar."""
+		if self.kind == RENAME:
+			return "%s renamed to %s on %s" % (self.old, self.name, self.server)
+		return "%s %s %s" % (self.name, 'joined' if self.kind == JOIN else 'left', self.server) ##}}}
+
+	##}}}
+
+def diff_players(old, new): ##{{{
+	"""
+	Compare two player lists of a server, sequences of
+	(name, frags) in slot order, and return a list of
+	(kind, name, old name) changes.
+
+	Players don't have ids in getstatus; a name that left
+	and one that joined at the same place in the lists are
+	taken for a rename unless the frags dropped, which
+	means someone new took the slot.
+	"""
+	left = collections.Counter(name for name, frags in old)
+	joined = collections.Counter(name for name, frags in new)
+	left, joined = left - joined, joined - left
+	changes = []
+	for (oldname, oldfrags), (name, frags) in zip(old, new):
+		if left[oldname] and joined[name] and frags >= oldfrags:
+			changes.append((RENAME, name, oldname))
+			left[oldname] -= 1
+			joined[name] -= 1
+	for name, count in left.items():
+		changes.extend([(LEAVE, name, None)] * count)
+	for name, count in joined.items():
+		changes.extend([(JOIN, name, None)] * count)
+	return changes ##}}}
+
+class PlayerEvents(object): ##{{{
+	"""
+	Turns successive player lists of servers into join,
+	leave and rename events for subscribers.
+
+	Only the last raw player lines of each server are
+	kept, with the hash of the names in them; they are
+	parsed only when a poll's names hash differently.
+	The first list seen of a server gives no events.
+	"""
+
+	def __init__(self): ##{{{
+		"""Create a tracker without subscribers."""
+		# address -> (hash of player names, raw player lines)
+		self.last = {}
+		self.subscribers = []
+		self.lock = threading.Lock() ##}}}
+
+	def subscribe(self, callback): ##{{{
+		"""
+		Have "callback" called with each PlayerEvent, from
+		whichever thread polled the server.
+		"""
+		with self.lock:
+			self.subscribers = self.subscribers + [callback] ##}}}
+
+	def unsubscribe(self, callback): ##{{{
+		"""Stop calling "callback"."""
+		with self.lock:
+			self.subscribers = [s for s in self.subscribers if s is not callback] ##}}}
+
+	def update(self, key, srv): ##{{{
+		"""
+		Look at a freshly polled server and send out the
+		events since its last poll. Servers whose players
+		weren't asked for are ignored.
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		"""
+		if not srv.detailed:
+			return
+		with self.lock:
+			old = self.last.get(key)
+			self.last[key] = (srv.playerhash, srv.rawplayers)
+			subscribers = self.subscribers
+		if old is None or old[0] == srv.playerhash or not subscribers:
+			return
+		before = [(p.name, p.frags) for p in server.parse_players(old[1].split("\n"), srv.filter)]
+		players = [(p.name, p.frags) for p in srv.players]
+		for kind, name, oldname in diff_players(before, players):
+			event = PlayerEvent(kind, key, srv.name2, name, oldname)
+			for callback in subscribers:
+				callback(event) ##}}}
+
+	##}}}
+
+class EventLog(object): ##{{{
+	"""
+	Subscriber appending events to a file as newline
+	delimited JSON, one object per line.
+	"""
+
+	def __init__(self, path): ##{{{
+		"""
+		Open "path" for appending
+
+		arguments:
+		path -- file to log to
+		"""
+		self.file = open(path, 'a')
+		self.lock = threading.Lock() ##}}}
+
+	def __call__(self, event): ##{{{
+		"""Log an event."""
+		line = json.dumps(event.to_dict()) + "\n"
+		with self.lock:
+			if self.file is not None:
+				self.file.write(line)
+				self.file.flush() ##}}}
+
+	def close(self): ##{{{
+		"""Close the file, later events are dropped."""
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None ##}}}
+
+	##}}}
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+import threading
+from server import normalize_name, normalize_names
+
+class PlayerIndex(object): ##{{{
+	"""
+	Inverted index from normalized player name to the
+	addresses of the servers that player was last seen on.
+
+	A reverse mapping of address to names is kept as well
+	so a server's stale entries can be dropped whenever a
+	new player list for it arrives.
+	"""
+
+	def __init__(self): ##{{{
+		"""Create an empty index."""
+		self.names = {}
+		self.servers = {}
+		self.lock = threading.Lock() ##}}}
+
+	def update(self, address, names): ##{{{
+		"""
+		Replace the players known for a server
+
+		arguments:
+		address -- address of the server
+		names -- iterable of (raw) player names on it
+		"""
+		names = set( normalize_names( list(names) ) )
+		names.discard( '' )
+		with self.lock:
+			old = self.servers.get( address, set() )
+			for name in old - names:
+				addresses = self.names[name]
+				addresses.discard( address )
+				if not addresses:
+					del self.names[name]
+			for name in names - old:
+				self.names.setdefault( name, set() ).add( address )
+			if names:
+				self.servers[address] = names
+			else:
+				self.servers.pop( address, None ) ##}}}
+
+	def remove(self, address): ##{{{
+		"""Forget all players of a server."""
+		self.update( address, () ) ##}}}
+
+	def lookup(self, name): ##{{{
+		"""
+		Return the set of server addresses a player is on
+
+		arguments:
+		name -- player name, normalized before the lookup
+		"""
+		with self.lock:
+			return set( self.names.get( normalize_name(name), () ) ) ##}}}
+
+	def clear(self): ##{{{
+		"""Forget everything."""
+		with self.lock:
+			self.names = {}
+			self.servers = {} ##}}}
+
+	##}}}
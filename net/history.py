@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+import array, threading
+
+# sparkline levels, lowest to highest
+LEVELS = ' .:-=+*#'
+
+class History(object): ##{{{
+	"""
+	The last few player counts of each server.
+
+	Samples are bytes in one array shared by all servers,
+	each address gets "size" of them used as a ring, with
+	its start and count in two more byte arrays; a server
+	costs size + 2 bytes and a dictionary entry. Sparklines
+	are cached per server until a sample changes them.
+	"""
+
+	def __init__(self, size=10): ##{{{
+		"""
+		Create an empty history
+
+		arguments:
+		size -- samples kept per server, at most 255
+		"""
+		assert 1 <= size <= 255
+		self.size = size
+		self.index = {}
+		self.samples = array.array('B')
+		self.starts = array.array('B')
+		self.counts = array.array('B')
+		# slot -> (top, sparkline)
+		self.lines = {}
+		self.lock = threading.Lock() ##}}}
+
+	def add(self, key, value): ##{{{
+		"""
+		Record a sample, dropping the oldest one of a full
+		ring. Returns whether the server's sparkline changed.
+
+		arguments:
+		key -- packed address of server
+		value -- player count, kept within 0-255
+		"""
+		value = min(max(int(value or 0), 0), 255)
+		size = self.size
+		with self.lock:
+			slot = self.index.get(key)
+			if slot is None:
+				slot = self.index[key] = len(self.index)
+				self.samples.extend([0] * size)
+				self.starts.append(0)
+				self.counts.append(0)
+			base = slot * size
+			start, count = self.starts[slot], self.counts[slot]
+			if count < size:
+				self.samples[base + (start + count) % size] = value
+				self.counts[slot] = count + 1
+				changed = True
+			else:
+				# a full ring of equal samples stays the same
+				changed = self.samples[base:base + size].count(value) != size
+				self.samples[base + start] = value
+				self.starts[slot] = (start + 1) % size
+			if changed:
+				self.lines.pop(slot, None)
+			return changed ##}}}
+
+	def values(self, key): ##{{{
+		"""Samples of a server, oldest first."""
+		with self.lock:
+			return self._values(self.index.get(key)) ##}}}
+
+	def _values(self, slot): ##{{{
+		"""Samples in a slot, oldest first. Call with the lock held."""
+		if slot is None:
+			return []
+		base = slot * self.size
+		start, count = self.starts[slot], self.counts[slot]
+		return [self.samples[base + (start + n) % self.size] for n in xrange(count)] ##}}}
+
+	def sparkline(self, key, top=None): ##{{{
+		"""
+		Return the samples of a server as a string of "size"
+		characters, newest on the right
+
+		arguments:
+		key -- packed address of server
+		top -- value drawn as the highest level, the server's
+		       maxclients (default = largest sample)
+		"""
+		with self.lock:
+			slot = self.index.get(key)
+			cached = self.lines.get(slot)
+			if cached is not None and cached[0] == top:
+				return cached[1]
+			values = self._values(slot)
+			high = top or max(values or [0]) or 1
+			last = len(LEVELS) - 1
+			line = ''.join(LEVELS[min(last, (value * last + high - 1) // high)] for value in values)
+			line = line.rjust(self.size)
+			if slot is not None:
+				self.lines[slot] = (top, line)
+			return line ##}}}
+
+	def trend(self, key): ##{{{
+		"""Newest sample minus the oldest one, 0 if unknown."""
+		values = self.values(key)
+		return values[-1] - values[0] if values else 0 ##}}}
+
+	##}}}
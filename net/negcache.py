@@ -0,0 +1,98 @@
+#!/usr/bin/env python2
+import address, socket as SO, threading, time
+
+class NegativeCache(object): ##{{{
+	"""
+	Remembers servers that don't answer.
+
+	After "threshold" failed scans in a row an address is
+	backed off: it is skipped until the backoff expires,
+	then probed once without retries. Every further
+	failure doubles the backoff, up to "maximum" seconds;
+	one answer forgets the address.
+
+	The cache is kept in a small text file, one address
+	per line with its failure count and backoff expiry.
+	"""
+
+	SKIP = 'skip'
+	PROBE = 'probe'
+	QUERY = 'query'
+
+	def __init__(self, path, threshold=2, base=300, maximum=86400): ##{{{
+		"""
+		Create a cache stored at "path", loading it if it
+		exists
+
+		arguments:
+		path -- file to keep the cache in
+		threshold -- failures in a row before backing off
+		base -- seconds of the first backoff
+		maximum -- longest backoff in seconds
+		"""
+		self.path = path
+		self.threshold = threshold
+		self.base = base
+		self.maximum = maximum
+		self.entries = {}
+		self.lock = threading.Lock()
+		self.load() ##}}}
+
+	def load(self): ##{{{
+		"""
+		Read the cache file, dropping addresses whose
+		backoff expired longer than "maximum" ago.
+		"""
+		now = time.time()
+		try:
+			cachefile = open(self.path)
+		except IOError:
+			return
+		with cachefile:
+			for line in cachefile:
+				try:
+					host, failures, until = line.split()
+					key = address.from_string(host)
+					failures, until = int(failures), float(until)
+				except (ValueError, SO.error):
+					continue
+				if until > now - self.maximum:
+					self.entries[key] = [failures, until] ##}}}
+
+	def save(self): ##{{{
+		"""Write the cache file."""
+		with self.lock:
+			entries = self.entries.items()
+		with open(self.path, 'w') as cachefile:
+			for key, (failures, until) in entries:
+				cachefile.write("%s %d %.0f\n" % (address.to_string(key), failures, until)) ##}}}
+
+	def check(self, key, now=None): ##{{{
+		"""
+		Return how to treat an address this scan: SKIP it,
+		PROBE it once or QUERY it as usual.
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+		if entry is None or entry[0] < self.threshold:
+			return self.QUERY
+		if (now or time.time()) < entry[1]:
+			return self.SKIP
+		return self.PROBE ##}}}
+
+	def failure(self, key, now=None): ##{{{
+		"""Count a scan the address didn't answer in."""
+		now = now or time.time()
+		with self.lock:
+			entry = self.entries.setdefault(key, [0, now])
+			entry[0] += 1
+			if entry[0] >= self.threshold:
+				backoff = self.base * 2 ** min(entry[0] - self.threshold, 16)
+				entry[1] = now + min(backoff, self.maximum) ##}}}
+
+	def success(self, key): ##{{{
+		"""Forget an address that answered."""
+		with self.lock:
+			self.entries.pop(key, None) ##}}}
+
+	##}}}
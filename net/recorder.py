@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+import address, argparse, os.path, Queue, sqlite3, threading, time
+
+SCHEMA = (
+	"CREATE TABLE IF NOT EXISTS samples (address TEXT NOT NULL, "
+		"time INTEGER NOT NULL, clients INTEGER, maxclients INTEGER, "
+		"map TEXT, gametype TEXT)",
+	# both indexes cover the columns the queries below read,
+	# so they never touch the table itself
+	"CREATE INDEX IF NOT EXISTS samples_time ON samples (time, clients, map)",
+	"CREATE INDEX IF NOT EXISTS samples_address ON samples (address, time, clients, map)",
+	)
+
+INSERT = "INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)"
+
+class Recorder(object): ##{{{
+	"""
+	Records the population of polled servers in a SQLite
+	database, for looking at days of history later.
+
+	record() only puts a row on a queue and never blocks;
+	if the queue is full the row is dropped. A background
+	thread owns the database and writes the rows in one
+	transaction per "batch" rows or "interval" seconds,
+	whichever comes first.
+	"""
+
+	def __init__(self, path, batch=500, interval=2.0, size=10000): ##{{{
+		"""
+		Open or create the database at "path" and start
+		the writer thread
+
+		arguments:
+		path -- database file
+		batch -- most rows written in one transaction
+		interval -- seconds rows may wait to be written
+		size -- rows queued before new ones are dropped
+		"""
+		self.path = path
+		self.batch = batch
+		self.interval = interval
+		self.queue = Queue.Queue(size)
+		self.dropped = 0
+		self.written = 0
+		self.error = None
+		# connect here so a bad path fails in the caller
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		for statement in SCHEMA:
+			self.db.execute(statement)
+		self.db.commit()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start() ##}}}
+
+	def record(self, key, srv): ##{{{
+		"""
+		Queue a row for a freshly polled server
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		"""
+		try:
+			self.queue.put_nowait((address.to_string(key), int(time.time()),
+					srv.clients, srv.maxclients, srv.map, srv.gametype))
+		except Queue.Full:
+			self.dropped += 1 ##}}}
+
+	def run(self): ##{{{
+		"""
+		Writer thread, collects rows into batches until
+		close() queues None.
+		"""
+		running = True
+		while running:
+			rows = [self.queue.get()]
+			if rows[0] is None:
+				break
+			deadline = time.time() + self.interval
+			while len(rows) < self.batch:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				try:
+					row = self.queue.get(timeout=remaining)
+				except Queue.Empty:
+					break
+				if row is None:
+					running = False
+					break
+				rows.append(row)
+			try:
+				with self.db:
+					self.db.executemany(INSERT, rows)
+				self.written += len(rows)
+			except sqlite3.Error, e:
+				self.error = str(e)
+		self.db.close() ##}}}
+
+	def close(self): ##{{{
+		"""Write what is queued and close the database."""
+		self.queue.put(None)
+		self.thread.join() ##}}}
+
+	##}}}
+
+def peak_hours(db, since, server=None): ##{{{
+	"""
+	Average and highest player count per hour of the day
+	(local time) since a time, of all servers or one.
+	Returns rows of (hour, average, highest, samples).
+	"""
+	query = ("SELECT strftime('%%H', time, 'unixepoch', 'localtime') AS hour, "
+			"AVG(clients), MAX(clients), COUNT(*) FROM samples %s "
+			"GROUP BY hour ORDER BY hour")
+	if server is None:
+		return db.execute(query % "WHERE time >= ?", (since,)).fetchall()
+	return db.execute(query % "WHERE address = ? AND time >= ?", (server, since)).fetchall() ##}}}
+
+def map_population(db, since, server=None): ##{{{
+	"""
+	Average and highest player count per map since a time,
+	of all servers or one, busiest maps first. Returns rows
+	of (map, average, highest, samples).
+	"""
+	query = ("SELECT map, AVG(clients) AS average, MAX(clients), COUNT(*) "
+			"FROM samples %s GROUP BY map ORDER BY average DESC")
+	if server is None:
+		return db.execute(query % "WHERE time >= ?", (since,)).fetchall()
+	return db.execute(query % "WHERE address = ? AND time >= ?", (server, since)).fetchall() ##}}}
+
+def main(): ##{{{
+	"""Command line to query a recorded database."""
+	parser = argparse.ArgumentParser(description="Query the population history recorded by cursow.")
+	parser.add_argument('report', choices=['peak', 'maps'],
+			help="peak: players per hour of the day, maps: players per map")
+	parser.add_argument('--db', default=os.path.expanduser('~/.cursow.db'),
+			help="database file (default: %(default)s)")
+	parser.add_argument('--days', type=float, default=7,
+			help="look at the last DAYS days (default: %(default)s)")
+	parser.add_argument('--server', metavar='IP:PORT',
+			help="only look at one server")
+	args = parser.parse_args()
+
+	if not os.path.exists(args.db):
+		parser.error("no database at %s" % args.db)
+	db = sqlite3.connect(args.db)
+	since = int(time.time() - args.days * 86400)
+	if args.report == 'peak':
+		print "hour  average  highest  samples"
+		for hour, average, highest, samples in peak_hours(db, since, args.server):
+			print "%4s  %7.1f  %7d  %7d" % (hour, average, highest, samples)
+	else:
+		print "%-20s  average  highest  samples" % "map"
+		for name, average, highest, samples in map_population(db, since, args.server):
+			print "%-20s  %7.1f  %7d  %7d" % (name, average, highest, samples)
+	db.close() ##}}}
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python2
+from net import Error
+import operator, shlex, subprocess, threading
+from server import normalize_name
+
+class RuleError(Error):
+	pass
+
+def _lower(attribute): ##{{{
+	"""Getter for a string field, compared without case."""
+	return lambda srv: (getattr(srv, attribute) or '').lower() ##}}}
+
+def _number(attribute): ##{{{
+	"""Getter for a numeric field, missing values are 0."""
+	return lambda srv: getattr(srv, attribute) or 0 ##}}}
+
+# fields rules can test, name -> (getter, numeric)
+FIELDS = {
+	'name': (lambda srv: normalize_name(srv.name or ''), False),
+	'map': (_lower('map'), False),
+	'mod': (_lower('mod'), False),
+	'gametype': (_lower('gametype'), False),
+	'host': (lambda srv: srv.host, False),
+	'port': (_number('port'), True),
+	'clients': (_number('clients'), True),
+	'maxclients': (_number('maxclients'), True),
+	'bots': (_number('bots'), True),
+	'players': (lambda srv: (srv.clients or 0) - (srv.bots or 0), True),
+	'free': (lambda srv: (srv.maxclients or 0) - (srv.clients or 0), True),
+	# None until measured, see compile_term
+	'ping': (lambda srv: srv.ping, True),
+	'password': (_number('password'), True),
+	'instagib': (_number('instagib'), True),
+	}
+
+OPERATORS = {
+	'==': operator.eq,
+	'!=': operator.ne,
+	'<': operator.lt,
+	'<=': operator.le,
+	'>': operator.gt,
+	'>=': operator.ge,
+	'~': lambda value, part: part in value,
+	}
+
+def compile_term(field, op, value): ##{{{
+	"""
+	Compile a single "field op value" test into a function
+	of a server. The value is converted once, here.
+	"""
+	try:
+		getter, numeric = FIELDS[field.lower()]
+	except KeyError:
+		raise RuleError("Unknown field %r" % field)
+	try:
+		test = OPERATORS[op]
+	except KeyError:
+		raise RuleError("Unknown operator %r" % op)
+	if numeric:
+		if op == '~':
+			raise RuleError("%s is a number, ~ only works on text" % field)
+		try:
+			value = float(value)
+		except ValueError:
+			raise RuleError("%s needs a number, not %r" % (field, value))
+		# an unknown value, like a ping not measured yet,
+		# matches no comparison
+		def term(srv):
+			current = getter(srv)
+			return current is not None and test(current, value)
+		return term
+	elif field.lower() == 'name':
+		value = normalize_name(value)
+	else:
+		value = value.lower()
+	return lambda srv: test(getter(srv), value) ##}}}
+
+def compile_expression(expression): ##{{{
+	"""
+	Compile an expression into a function of a server and
+	return it with the set of fields it uses.
+
+	An expression is "field op value" terms joined by "and"
+	and "or", where "and" binds tighter; values with spaces
+	may be quoted. For example
+	gametype == duel and map == wamphi1 and clients == 1
+	"""
+	try:
+		tokens = shlex.split(expression)
+	except ValueError, e:
+		raise RuleError("Bad quoting: %s" % e)
+	alternatives = [[]]
+	fields = set()
+	n = 0
+	while True:
+		if len(tokens) < n + 3:
+			raise RuleError("Incomplete term in %r" % expression)
+		field, op, value = tokens[n:n+3]
+		alternatives[-1].append(compile_term(field, op, value))
+		fields.add(field.lower())
+		n += 3
+		if n == len(tokens):
+			break
+		joiner = tokens[n].lower()
+		if joiner == 'or':
+			alternatives.append([])
+		elif joiner != 'and':
+			raise RuleError("Expected and/or, not %r" % tokens[n])
+		n += 1
+
+	def conjunction(terms):
+		if len(terms) == 1:
+			return terms[0]
+		return lambda srv: all(term(srv) for term in terms)
+	tests = [conjunction(terms) for terms in alternatives]
+	if len(tests) == 1:
+		return tests[0], fields
+	return (lambda srv: any(test(srv) for test in tests)), fields ##}}}
+
+class Rule(object): ##{{{
+	"""
+	A named condition on servers, compiled once, with an
+	optional command to run when a server starts matching.
+	"""
+
+	def __init__(self, name, expression, command=None): ##{{{
+		"""
+		Compile a rule, raises RuleError if the
+		expression is malformed
+
+		arguments:
+		name -- name shown when the rule fires
+		expression -- condition, see compile_expression
+		command -- command line run when it fires, "{field}"
+		           in its arguments is replaced by the
+		           server's value, "{address}" by ip:port
+		"""
+		self.name = name
+		self.expression = expression
+		self.test, self.fields = compile_expression(expression)
+		if command:
+			try:
+				self.command = shlex.split(command)
+			except ValueError, e:
+				raise RuleError("Bad quoting: %s" % e)
+		else:
+			self.command = None ##}}}
+
+	def run(self, srv): ##{{{
+		"""
+		Run the rule's command for a server, without a shell
+		so server names can't inject anything. Returns the
+		process, None without a command.
+		"""
+		if self.command is None:
+			return None
+		values = dict((field, getter(srv)) for field, (getter, numeric) in FIELDS.items())
+		values['name'] = srv.name2
+		values['address'] = srv.address()
+		args = [arg.format(**values) for arg in self.command]
+		with open('/dev/null', 'r+') as null:
+			return subprocess.Popen(args, stdin=null, stdout=null, stderr=null, close_fds=True) ##}}}
+
+	##}}}
+
+class RuleSet(object): ##{{{
+	"""
+	Rules evaluated as servers are polled.
+
+	Only the fields used by some rule are looked at. Each
+	server's values of them are remembered and the rules
+	only run again when one changed, so unchanged polls of
+	thousands of servers cost a tuple compare each. Rules
+	are edge triggered: one fires when a server starts to
+	match it and not again until it stopped matching.
+	"""
+
+	def __init__(self, rules=()): ##{{{
+		"""
+		Create a set of compiled rules
+
+		arguments:
+		rules -- Rule objects
+		"""
+		self.rules = list(rules)
+		fields = set()
+		for rule in self.rules:
+			fields |= rule.fields
+		self.getters = [FIELDS[field][0] for field in sorted(fields)]
+		# address -> (values of the fields, names of rules matched)
+		self.state = {}
+		self.lock = threading.Lock() ##}}}
+
+	def check(self, key, srv): ##{{{
+		"""
+		Evaluate the rules for a freshly polled server and
+		return those it started matching
+
+		arguments:
+		key -- packed address of server
+		srv -- the server object
+		"""
+		if not self.rules:
+			return []
+		values = tuple(getter(srv) for getter in self.getters)
+		with self.lock:
+			old = self.state.get(key)
+			if old is not None and old[0] == values:
+				return []
+			matched = frozenset(rule.name for rule in self.rules if rule.test(srv))
+			self.state[key] = (values, matched)
+		before = old[1] if old is not None else frozenset()
+		return [rule for rule in self.rules if rule.name in matched and rule.name not in before] ##}}}
+
+	##}}}
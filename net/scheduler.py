@@ -0,0 +1,528 @@
+#!/usr/bin/env python2
+import address, collections, heapq, itertools, random, threading, time
+
+class Window(object): ##{{{
+	"""
+	Adaptive limit on the number of queries in flight.
+
+	The window grows additively, by about one query per
+	window's worth of replies that came back in time, and
+	is cut multiplicatively when a query times out; at
+	most once per timeout period, so a burst of losses
+	only counts once. Only addresses that answered before
+	count: a timeout on first contact is most likely a
+	server that is gone, not congestion.
+	"""
+
+	def __init__(self, initial=4, minimum=1, maximum=32, timeout=1.0, decrease=0.5, answered=None): ##{{{
+		"""
+		Create a window of "initial" queries, kept between
+		"minimum" and "maximum". Replies slower than
+		"timeout" seconds count as losses. "answered" is the
+		set of addresses known to have replied, shared with
+		the window of an earlier scan.
+		"""
+		self.size = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.timeout = timeout
+		self.decrease = decrease
+		self.inflight = 0
+		# statistics
+		self.replies = 0
+		self.losses = 0
+		self.unanswered = 0
+		self.answered = set() if answered is None else answered
+		self.rtts = collections.deque(maxlen=256)
+		self.started = time.time()
+		self.decreased = 0
+		self.condition = threading.Condition() ##}}}
+
+	def acquire(self): ##{{{
+		"""Wait until the window has room for another query."""
+		with self.condition:
+			while self.inflight >= int(self.size):
+				self.condition.wait()
+			self.inflight += 1 ##}}}
+
+	def release(self, ok, rtt=None, key=None): ##{{{
+		"""
+		Finish a query and adapt the window
+
+		arguments:
+		ok -- whether a reply arrived
+		rtt -- seconds the reply took, if any
+		key -- packed address queried, a timeout of one that
+		       never answered isn't counted as a loss
+		"""
+		now = time.time()
+		with self.condition:
+			self.inflight -= 1
+			if ok and key is not None:
+				self.answered.add(key)
+			if ok and rtt is not None:
+				self.rtts.append(rtt)
+			if ok and (rtt is None or rtt < self.timeout):
+				self.replies += 1
+				self.size = min(self.maximum, self.size + 1.0 / self.size)
+			elif not ok and key is not None and key not in self.answered:
+				self.unanswered += 1
+			else:
+				if ok:
+					self.replies += 1
+				self.losses += 1
+				if now - self.decreased > self.timeout:
+					self.size = max(self.minimum, self.size * self.decrease)
+					self.decreased = now
+			self.condition.notify_all() ##}}}
+
+	def cancel(self): ##{{{
+		"""Give back a slot taken by acquire() unused."""
+		with self.condition:
+			self.inflight -= 1
+			self.condition.notify_all() ##}}}
+
+	def get_window(self): ##{{{
+		"""Current number of queries allowed in flight."""
+		return int(self.size) ##}}}
+
+	def get_loss_rate(self): ##{{{
+		"""Fraction of queries that timed out or were late."""
+		total = self.replies + self.losses
+		return float(self.losses) / total if total else 0.0 ##}}}
+
+	def get_rtt(self, percentile=0.95, samples=20): ##{{{
+		"""
+		Round trip time below which "percentile" of the
+		recent replies arrived, None until we've seen
+		"samples" of them.
+		"""
+		with self.condition:
+			rtts = sorted(self.rtts)
+		if len(rtts) < samples:
+			return None
+		return rtts[min(len(rtts) - 1, int(len(rtts) * percentile))] ##}}}
+
+	def get_rate(self): ##{{{
+		"""Replies per second since the window was created."""
+		elapsed = time.time() - self.started
+		return self.replies / elapsed if elapsed > 0 else 0.0 ##}}}
+
+	##}}}
+
+class Intervals(object): ##{{{
+	"""
+	Refresh intervals per address.
+
+	A server whose value (its player count, say) changed
+	since the last poll is polled twice as often, one
+	where it stayed the same a bit less often. Servers
+	start out at "base" seconds, empty ones at "maximum".
+	"""
+
+	def __init__(self, base=30.0, minimum=10.0, maximum=300.0, slower=1.5, jitter=0.1): ##{{{
+		"""
+		Create intervals between "minimum" and "maximum"
+		seconds, growing by "slower" while nothing changes.
+		Delays are spread by +- "jitter" so servers found
+		together don't stay due together.
+		"""
+		self.base = base
+		self.minimum = minimum
+		self.maximum = maximum
+		self.slower = slower
+		self.jitter = jitter
+		self.entries = {}
+		self.lock = threading.Lock() ##}}}
+
+	def next(self, key, value): ##{{{
+		"""
+		Return the seconds until the next poll of an address
+
+		arguments:
+		key -- packed address
+		value -- what the poll found, None if it failed;
+		         failures wait "maximum" and aren't counted
+		"""
+		if value is None:
+			interval = self.maximum
+		else:
+			with self.lock:
+				interval, last = self.entries.get(key, (None, None))
+				if interval is None:
+					interval = self.base if value else self.maximum
+				elif value != last:
+					interval = max(self.minimum, interval / 2)
+				else:
+					interval = min(self.maximum, interval * self.slower)
+				self.entries[key] = (interval, value)
+		return interval * random.uniform(1 - self.jitter, 1 + self.jitter) ##}}}
+
+	def clear(self): ##{{{
+		"""Forget all intervals."""
+		with self.lock:
+			self.entries = {} ##}}}
+
+	##}}}
+
+class Scheduler(object): ##{{{
+	"""
+	Hands out server addresses to query.
+
+	Addresses are handed out by priority, lower numbers
+	first. Within a priority they are grouped by host
+	(many servers share an ip) and handed out round robin
+	across hosts, with at most "per_host" queries in flight
+	on any one host, so we don't hit a box with a burst it
+	will rate limit. The total in flight is limited by a
+	Window.
+
+	Each host has a heap of its queued addresses; changing
+	an address's priority pushes a new entry and the old
+	one is skipped when it comes up. Hosts with room for
+	another query wait in a heap of their own, ordered by
+	their best priority and then by when they were last
+	served, so a pick doesn't look at busy hosts at all.
+	Addresses may also be added with a delay,
+	they wait in another heap ordered by due time; while
+	any are waiting the scheduler isn't done. One kept
+	open is never done, it hands out what is added to it
+	until it is closed.
+
+	Failed queries are tried again, but retries only get
+	capacity first tries can't use. With a deadline no
+	query is handed out that couldn't finish in time and
+	what is left when it passes is collected in cutoff.
+	"""
+
+	# Connection won't wait any shorter for a reply
+	MIN_TIMEOUT = 0.1
+
+	def __init__(self, keys, window, per_host=2, attempts=3, deadline=None, keep_open=False): ##{{{
+		"""
+		Schedule the given packed addresses
+
+		arguments:
+		keys -- packed addresses, see net.address
+		window -- Window limiting queries in flight
+		per_host -- queries in flight per host
+		attempts -- tries per address before giving up
+		deadline -- time.time() by which the scan must be
+		            done, None for no limit
+		keep_open -- when nothing is left wait for addresses
+		             to be added instead of finishing, until
+		             close()
+		"""
+		self.window = window
+		self.per_host = per_host
+		self.attempts = attempts
+		self.deadline = deadline
+		self.keep_open = keep_open
+		# host -> heap of (priority, order added, address);
+		# queued maps each address to its current entry,
+		# other entries are stale
+		self.hosts = {}
+		self.queued = {}
+		self.order = itertools.count()
+		# heap of (best priority, turn, host) of hosts under
+		# their limit with addresses queued; ready_hosts maps
+		# each host to its current entry
+		self.ready = []
+		self.ready_hosts = {}
+		self.turns = itertools.count()
+		# heap of (due time, order added, address, priority);
+		# waiting maps each address to its current entry
+		self.delayed = []
+		self.waiting = {}
+		self.closed = False
+		self.retries = collections.deque()
+		self.tries = {}
+		self.inflight = {}
+		self.running = set()
+		self.busy = 0
+		self.cutoff = set()
+		self.condition = threading.Condition()
+		for key in keys:
+			self.add(key) ##}}}
+
+	def add(self, key, attempts=None, priority=0, delay=None): ##{{{
+		"""
+		Queue an address to be handed out
+
+		arguments:
+		key -- packed address
+		attempts -- tries before giving up (default = scheduler's)
+		priority -- addresses with lower ones go first (default = 0)
+		delay -- seconds before it may be handed out (default = none)
+		"""
+		with self.condition:
+			self.tries[key] = attempts or self.attempts
+			if delay:
+				self.queued.pop(key, None)
+				entry = (time.time() + delay, next(self.order), key, priority)
+				self.waiting[key] = entry
+				heapq.heappush(self.delayed, entry)
+			else:
+				self.waiting.pop(key, None)
+				self.queue(key, priority)
+			self.condition.notify() ##}}}
+
+	def queue(self, key, priority): ##{{{
+		"""Queue an address now. Call with the condition held."""
+		entry = (priority, next(self.order), key)
+		self.queued[key] = entry
+		host = address.host(key)
+		heapq.heappush(self.hosts.setdefault(host, []), entry)
+		self.wake(host) ##}}}
+
+	def first(self, host): ##{{{
+		"""
+		Return the first current entry of a host's heap, None
+		if it has none. Call with the condition held.
+		"""
+		heap = self.hosts.get(host)
+		while heap and self.queued.get(heap[0][2]) is not heap[0]:
+			heapq.heappop(heap)
+		if not heap:
+			self.hosts.pop(host, None)
+			return None
+		return heap[0] ##}}}
+
+	def wake(self, host): ##{{{
+		"""
+		Put a host in the ready heap if it is under its limit
+		and has addresses queued, or move it up if its first
+		one got a lower priority. Call with the condition held.
+		"""
+		if self.inflight.get(host, 0) >= self.per_host:
+			return
+		entry = self.first(host)
+		if entry is None:
+			return
+		current = self.ready_hosts.get(host)
+		if current is not None and current[0] <= entry[0]:
+			return
+		current = (entry[0], next(self.turns), host)
+		self.ready_hosts[host] = current
+		heapq.heappush(self.ready, current) ##}}}
+
+	def prioritize(self, keys, priority, add=False): ##{{{
+		"""
+		Move addresses still queued up to "priority",
+		addresses queued with a lower one stay put.
+		Addresses waiting for their delay or for a retry
+		are queued now at "priority". Returns the set of
+		addresses that are queued now.
+
+		arguments:
+		keys -- packed addresses
+		priority -- new priority
+		add -- also queue the addresses that are neither
+		       waiting nor in flight
+		"""
+		queued = set()
+		with self.condition:
+			for key in keys:
+				entry = self.queued.get(key)
+				if entry is not None:
+					if entry[0] > priority:
+						self.queue(key, priority)
+				elif self.waiting.pop(key, None) is not None:
+					self.queue(key, priority)
+				elif key in self.retries:
+					self.retries.remove(key)
+					self.queue(key, priority)
+				elif add and key not in self.running:
+					self.tries[key] = self.attempts
+					self.queue(key, priority)
+				else:
+					continue
+				queued.add(key)
+			self.condition.notify()
+		return queued ##}}}
+
+	def remove(self, key): ##{{{
+		"""
+		Stop handing out an address that is queued, waiting
+		or due for a retry. A query in flight isn't stopped.
+		"""
+		with self.condition:
+			self.queued.pop(key, None)
+			self.waiting.pop(key, None)
+			self.tries.pop(key, None)
+			if key in self.retries:
+				self.retries.remove(key)
+			self.wake(address.host(key))
+			self.condition.notify_all() ##}}}
+
+	def remaining(self): ##{{{
+		"""Seconds left until the deadline, None without one."""
+		if self.deadline is None:
+			return None
+		return self.deadline - time.time() ##}}}
+
+	def timeout(self, timeout): ##{{{
+		"""
+		Shorten a query's timeout so it ends by the deadline.
+		Under a deadline we also give up after a few times
+		the usual round trip, so dead servers don't keep the
+		slots that could get other answers in.
+		"""
+		remaining = self.remaining()
+		if remaining is None:
+			return timeout
+		rtt = self.window.get_rtt()
+		if rtt is not None:
+			timeout = min(timeout, 4 * rtt)
+		return max(self.MIN_TIMEOUT, min(timeout, remaining)) ##}}}
+
+	def pick(self): ##{{{
+		"""
+		Pick the next address: the first try coming first
+		whose host is under its limit, else a retry on such
+		a host. Return False if we have to wait for queries
+		to finish and None if nothing is left to do. Call
+		with the condition held.
+		"""
+		now = time.time()
+		while self.delayed and self.delayed[0][0] <= now:
+			entry = heapq.heappop(self.delayed)
+			if self.waiting.get(entry[2]) is entry:
+				del self.waiting[entry[2]]
+				self.queue(entry[2], entry[3])
+
+		while self.ready:
+			ready = heapq.heappop(self.ready)
+			host = ready[2]
+			if self.ready_hosts.get(host) is not ready:
+				continue
+			del self.ready_hosts[host]
+			if self.inflight.get(host, 0) >= self.per_host:
+				# a retry took the room, done() wakes it again
+				continue
+			entry = self.first(host)
+			if entry is None or entry[0] > ready[0]:
+				# its first address was taken or moved down
+				self.wake(host)
+				continue
+			heapq.heappop(self.hosts[host])
+			key = entry[2]
+			del self.queued[key]
+			self.take(key)
+			# back in line behind the hosts of the same priority
+			self.wake(host)
+			return key
+
+		for n in xrange(len(self.retries)):
+			key = self.retries[n]
+			if self.inflight.get(address.host(key), 0) < self.per_host:
+				del self.retries[n]
+				return self.take(key)
+
+		if not self.queued and not self.retries and not self.busy and not self.waiting \
+				and not self.keep_open:
+			return None
+		return False ##}}}
+
+	def take(self, key): ##{{{
+		"""Count an address as in flight and return it."""
+		host = address.host(key)
+		self.inflight[host] = self.inflight.get(host, 0) + 1
+		self.running.add(key)
+		self.busy += 1
+		return key ##}}}
+
+	def put_back(self, key): ##{{{
+		"""Stop counting an address taken as in flight."""
+		host = address.host(key)
+		self.inflight[host] -= 1
+		if not self.inflight[host]:
+			del self.inflight[host]
+		self.busy -= 1
+		self.running.discard(key)
+		self.wake(host)
+		self.condition.notify_all() ##}}}
+
+	def cut(self): ##{{{
+		"""Move everything still queued to cutoff."""
+		self.cutoff.update(self.queued)
+		self.cutoff.update(self.retries)
+		self.cutoff.update(self.waiting)
+		self.hosts = {}
+		self.queued = {}
+		self.ready = []
+		self.ready_hosts = {}
+		self.delayed = []
+		self.waiting = {}
+		self.retries.clear() ##}}}
+
+	def close(self): ##{{{
+		"""Make get() return None from now on."""
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all() ##}}}
+
+	def get(self): ##{{{
+		"""
+		Wait for an address that may be queried now and
+		return it, None once nothing is left to query, the
+		deadline has come or we were closed.
+		"""
+		with self.condition:
+			while True:
+				if self.closed:
+					return None
+				remaining = self.remaining()
+				if remaining is not None and remaining < self.MIN_TIMEOUT:
+					self.cut()
+					return None
+				key = self.pick()
+				if key is not False:
+					break
+				wait = remaining
+				while self.delayed and self.waiting.get(self.delayed[0][2]) is not self.delayed[0]:
+					heapq.heappop(self.delayed)
+				if self.delayed:
+					due = self.delayed[0][0] - time.time()
+					wait = due if wait is None else min(wait, due)
+				self.condition.wait(wait)
+		if key is not None:
+			self.window.acquire()
+			## The window may have kept us past the deadline
+			remaining = self.remaining()
+			if remaining is not None and remaining < self.MIN_TIMEOUT:
+				self.window.cancel()
+				with self.condition:
+					self.put_back(key)
+					self.cutoff.add(key)
+					self.cut()
+				return None
+		return key ##}}}
+
+	def done(self, key, ok, rtt=None): ##{{{
+		"""
+		Report a query handed out by get() as finished.
+		Returns True if the address was queued for
+		another try.
+
+		arguments:
+		key -- the address queried
+		ok -- whether a reply arrived
+		rtt -- seconds the reply took, if any
+		"""
+		self.window.release(ok, rtt, key)
+		with self.condition:
+			self.put_back(key)
+
+			tries = self.tries.pop(key, 1) - 1
+			if ok or not tries:
+				return False
+			remaining = self.remaining()
+			if remaining is not None and remaining < self.MIN_TIMEOUT:
+				self.cutoff.add(key)
+				return False
+			self.tries[key] = tries
+			self.retries.append(key)
+			return True ##}}}
+
+	##}}}
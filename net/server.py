@@ -1,5 +1,5 @@
 #!/usr/bin/env python2
-import net, connection, re, subprocess
+import net, connection, address, re, struct, subprocess
 
 class REs(object): ##{{{
 	"""
@@ -10,16 +10,85 @@ class REs(object): ##{{{
 	# parse a player line from "getstatus" command
 	# 11 50 "|ALPHA|MarvinTheSpud"
 	GETSTATUS = re.compile(r'^(-?)(\d+) (\d+) "(.*)"')
+	# the ping of every player line of a getstatus reply, it
+	# changes with every poll
+	# 11 50 "|ALPHA|MarvinTheSpud"
+	PLAYER_PING = re.compile(r'^(-?\d+) \d+ ', re.M)
+	# the names of all player lines of a getstatus reply
+	PLAYER_NAME = re.compile(r'^-?\d+ \d+ "(.*)"', re.M)
 	# parse a player line from "rcon status" command
 	# 2 0 70 |ALPHA| Mad Professor^7 0 127.0.0.1:35107 229 25000
 	RCON_STATUS = re.compile(r'\s*(\d+)\s+(-?)(\d+)\s+(\d+)\s+(.*)\^7\s+(\d+)\s+(\S*)\s+(\d+)\s+(\d+)')
 	STRIPCOLOR = re.compile(r'(\^[0-9])')
+	# pick the variables we show out of a getstatus or getinfo
+	# response, every other key\value pair is matched but not
+	# captured
+	# \sv_hostname\Foo\mapname\wdm1
+	FIELDS = re.compile(r'\\(?:(sv_hostname|tv_name|gametype|clients|sv_maxclients|'
+			r'g_needpass|g_instagib|bots|gamename|mapname|fs_game|protocol|version)|[^\\]*)\\([^\\]*)')
+	# separator of the short info string, one or more backslashes
+	# \\n\\Foo\\m\\    wdm1\\u\\ 2/16\\EOT
+	INFO_SEPARATOR = re.compile(r'\\+')
 	PING = re.compile( r'\d+\.\d+/(\d+\.\d+)/\d+\.\d+/\d+\.\d+')
 	##}}}
 
+# keys of the short info string Warsow sends for its own
+# "info" query, and the variables they stand for; "u" is
+# "clients/maxclients"
+INFO_KEYS = {'n': 'sv_hostname', 'm': 'mapname', 'g': 'gametype',
+		'mo': 'fs_game', 'ig': 'g_instagib', 'p': 'g_needpass', 'b': 'bots'}
+
+# memo of stripped/normalized names, names repeat a lot
+# between servers and refreshes; dropped when it gets big
+_stripped = {}
+_normalized = {}
+MEMO_SIZE = 20000
+
+def strip_colors(name): ##{{{
+	"""Remove Quake 3 color codes (^0 - ^9) from a name."""
+	if "^" not in name:
+		return name
+	try:
+		return _stripped[name]
+	except KeyError:
+		if len(_stripped) > MEMO_SIZE:
+			_stripped.clear()
+		result = _stripped[name] = REs.STRIPCOLOR.sub('', name)
+		return result ##}}}
+
+def strip_colors_all(names): ##{{{
+	"""
+	Remove color codes from a list of names in one
+	pass, names can't contain newlines so they are
+	joined, substituted once and split again.
+	"""
+	if not names:
+		return []
+	return REs.STRIPCOLOR.sub('', "\n".join(names)).split("\n") ##}}}
+
+def normalize_name(name): ##{{{
+	"""
+	Name used for searching and sorting: color codes
+	removed, surrounding whitespace dropped, lowercase.
+	"""
+	try:
+		return _normalized[name]
+	except KeyError:
+		if len(_normalized) > MEMO_SIZE:
+			_normalized.clear()
+		result = _normalized[name] = strip_colors(name).strip().lower()
+		return result ##}}}
+
+def normalize_names(names): ##{{{
+	"""Bulk version of normalize_name."""
+	return [name.strip().lower() for name in strip_colors_all(names)] ##}}}
+
 class Player(object): ##{{{
 	"""Record collecting information about a player."""
 
+	__slots__ = ('frags', 'ping', 'name', 'address', 'slot', 'lastmsg',
+			'qport', 'rate', 'guid', 'variables')
+
 	def __init__(self): ##{{{
 		"""Create empty record with lots of None fields."""
 		# information from getstatus request
@@ -43,27 +112,91 @@ class Player(object): ##{{{
 
 	## }}}
 
+def parse_players(data, filter=False): ##{{{
+	"""
+	Parse the player lines of a getstatus response into
+	a list of Player records.
+
+	arguments:
+	data -- sequence of player lines
+	filter -- strip colors from the names
+	"""
+	players = []
+
+	for record in data:
+
+		match = REs.GETSTATUS.match(record)
+		if match:
+			negative, frags, ping, name = match.groups()
+			if negative == "-":
+				frags = "-" + frags
+			if filter:
+				name = strip_colors(name)
+
+			player = Player()
+			player.frags = int(frags)
+			player.ping = int(ping)
+			player.name = name
+			players.append(player)
+	return players ##}}}
+
 class Server(object): ##{{{
-	"""Record collecting information about a server."""
+	"""
+	Record collecting information about a server.
 
-	def __init__(self, host, port, filter_colors=False): ##{{{
-		"""Create empty record with lots of None fields."""
+	Thousands of these are kept around, so they have no
+	__dict__ and hold no connection; one is opened for
+	each command. Values repeated across servers (host,
+	map, mod, gametype...) are interned.
+	"""
+
+	__slots__ = ('filter', 'host', 'port', 'key', 'name', 'game', 'map', 'mod',
+			'gametype', 'protocol', 'version', 'clients', 'maxclients',
+			'bots', 'instagib', 'password', 'ping', 'detailed', 'digest',
+			'rawvariables', 'rawplayers', 'playerhash', '_variables', '_players')
+
+	def __init__(self, host, port, filter_colors=False, key=None): ##{{{
+		"""
+		Create empty record with lots of None fields. "key"
+		is the packed address, see net.address; it is
+		packed from host and port if not given.
+		"""
 		# meta information before connect
-		self.connection = connection.Connection(host, port, retries=3)
 		self.filter = filter_colors
-		self.host = host
+		self.host = intern(host)
 		self.port = port
+		self.key = key if key is not None else address.pack(host, port)
 		# shortcuts to well-known variables
 		self.name = None
 		self.game = None
 		self.map = None
+		self.mod = None
+		self.gametype = None
 		self.protocol = None
 		self.version = None
+		self.clients = None
+		self.maxclients = None
 		self.bots = None
-		# dict of *all* server variables
-		self.variables = {}
-		# list of players
-		self.players = [] ##}}}
+		self.instagib = None
+		self.password = None
+		# measured by getPing(), replies leave it alone so
+		# it lasts across refreshes
+		self.ping = None
+		# whether variables and players came with a getstatus
+		# reply, getinfo only fills in the shortcuts
+		self.detailed = False
+		# hash of the last reply parsed without the player
+		# pings, a reply hashing the same isn't parsed again
+		self.digest = None
+		# unparsed variables and players, see the
+		# variables and players properties below
+		self.rawvariables = ''
+		self.rawplayers = ''
+		# hash of the normalized player names, tells if
+		# players came or went
+		self.playerhash = None
+		self._variables = None
+		self._players = None ##}}}
 
 	def address(self): ##{{{
 		"""Helper to get "ip:port" for a server."""
@@ -73,72 +206,145 @@ class Server(object): ##{{{
 		"""Compatibiltiy alias for address()."""
 		return self.address() ##}}}
 
-	def command(self, command): ##{{{
-		"""Wrapper calling Connection.command() for a server."""
-		return self.connection.command(command) ##}}}
+	def command(self, command, pool=None, multi=True, hedge=None, timeout=1.0, retries=3): ##{{{
+		"""
+		Wrapper calling Connection.command() for a server,
+		borrowing the socket from a SocketPool if given.
+		"""
+		with connection.Connection(self.host, self.port, timeout=timeout, retries=retries, pool=pool) as conn:
+			return conn.command(command, multi, hedge) ##}}}
 
 	def filter_name(self, name): ##{{{
-		"""Helper to remove Quake 3 color codes from player names."""
-		result = ""
-		i = 0
-		while i < len(name):
-			if name[i] == "^":
-				i += 2
-			else:
-				result += name[i]
-				i += 1
-		return result ##}}}
+		"""Compatibility alias for strip_colors()."""
+		return strip_colors(name) ##}}}
 
 	def parse_getstatus_variables(self, data): ##{{{
 		"""
 		Parse variables portion of getstatus response.
-		The format is "\\key\\value\\key\\value..." and
-		we turn that into a dictionary; selected values
-		are also made fields.
-		"""
-		data = data.split("\\")[1:]
-		assert len(data) % 2 == 0
-		keys = data[0::2]
-		values = data[1::2]
-		self.variables = dict(zip(keys, values))
-
-		self.clients = int(self.variables.get('clients', 1))
-		if 'sv_hostname' in self.variables:
-			self.name = self.variables['sv_hostname']
-			self.name2 = re.sub( REs.STRIPCOLOR, '', self.name )
-			self.gametype = self.variables.get("gametype", '')
-		elif 'tv_name' in self.variables:
-			self.name = self.variables['tv_name']
-			self.name2 = re.sub( REs.STRIPCOLOR, '', self.name )
+		The format is "\\key\\value\\key\\value..."; only
+		the selected values made fields are picked out
+		here, the dictionary of all of them is built on
+		first use of self.variables.
+		"""
+		self.rawvariables = data
+		self._variables = None
+		self.parse_fields(self.match_fields(data)) ##}}}
+
+	def match_fields(self, data): ##{{{
+		"""
+		Pick the values of the variables we show out of a
+		"\\key\\value..." string into a dictionary.
+		"""
+		fields = {}
+		for match in REs.FIELDS.finditer(data):
+			key = match.group(1)
+			if key:
+				fields[key] = match.group(2)
+		return fields ##}}}
+
+	def parse_fields(self, fields): ##{{{
+		"""
+		Set the shortcuts to well-known variables from
+		a dictionary made by match_fields().
+		"""
+		self.clients = int(fields.get('clients', 1))
+		if 'sv_hostname' in fields:
+			self.name = fields['sv_hostname']
+			self.gametype = intern(fields.get("gametype", ''))
+		elif 'tv_name' in fields:
+			self.name = fields['tv_name']
 			self.gametype = 'tv'
 		else:
 			self.name = ''
-			self.name2 = ''
 			self.gametype = ''
 
 		try:
-			self.instagib = int(float(self.variables.get( 'g_instagib', 0 )))
+			self.instagib = int(float(fields.get( 'g_instagib', 0 )))
 		except ValueError:
 			self.instagib = 0
 		try:
-			self.maxclients = int(float(self.variables.get( 'sv_maxclients', 0 )))
+			self.maxclients = int(float(fields.get( 'sv_maxclients', 0 )))
 		except ValueError:
 			self.maxclients = 0
 		try:
-			self.password = int(float(self.variables.get( 'g_needpass', 0 )))
+			self.password = int(float(fields.get( 'g_needpass', 0 )))
 		except ValueError:
 			self.password = 0
 		try:
-			self.bots = int(float(self.variables.get( 'bots', 0 )))
+			self.bots = int(float(fields.get( 'bots', 0 )))
 		except ValueError:
 			self.bots = 0
 
-		self.game = self.variables.get('gamename', '')
-		self.map = self.variables.get("mapname", '')
-		self.mod = self.variables.get("fs_game", '')
-		self.ping = 0
-		self.protocol = self.variables["protocol"]
-		self.version = self.variables["version"] ##}}}
+		self.game = intern(fields.get('gamename', ''))
+		self.map = intern(fields.get("mapname", ''))
+		self.mod = intern(fields.get("fs_game", ''))
+		self.protocol = intern(fields.get("protocol", ''))
+		self.version = intern(fields.get("version", '')) ##}}}
+
+	def match_info_fields(self, data): ##{{{
+		"""
+		Pick the values of the short info string, keys
+		and values separated by backslashes and ended by
+		"EOT", into a dictionary like match_fields() does.
+		Values are padded with spaces, those are dropped.
+		"""
+		tokens = REs.INFO_SEPARATOR.split(data.strip("\\"))
+		fields = {}
+		for key, value in zip(tokens[0::2], tokens[1::2]):
+			value = value.strip()
+			if key == 'u':
+				clients, sep, maxclients = value.partition('/')
+				fields['clients'] = clients.strip()
+				fields['sv_maxclients'] = maxclients.strip()
+			elif key in INFO_KEYS:
+				fields[INFO_KEYS[key]] = value
+		return fields ##}}}
+
+	def parse_getinfo(self, data, accept=None): ##{{{
+		"""
+		Parse server response to getinfo command, a single
+		line of variables just about enough for the server
+		list. Either the variables getstatus has too, or the
+		short info string (see INFO_KEYS). Variables and
+		players are left alone, they only come with
+		getstatus. Returns None if the reply doesn't have
+		the player counts, else like parse_getstatus.
+		"""
+		digest = hash(data)
+		if digest != self.digest:
+			data = data.strip()
+			fields = self.match_fields(data)
+			if 'clients' not in fields:
+				fields = self.match_info_fields(data)
+			if 'clients' not in fields or 'sv_maxclients' not in fields:
+				return None
+			self.digest = digest
+			self.parse_fields(fields)
+
+		if accept is not None and not accept(self):
+			return False
+		return True ##}}}
+
+	def get_name2(self): ##{{{
+		"""Server name without color codes."""
+		return strip_colors(self.name) ##}}}
+
+	name2 = property(get_name2)
+
+	def get_variables(self): ##{{{
+		"""
+		Dictionary of *all* server variables, parsed
+		from the raw response the first time it's used.
+		"""
+		if self._variables is None:
+			data = self.rawvariables.split("\\")[1:]
+			assert len(data) % 2 == 0
+			keys = data[0::2]
+			values = data[1::2]
+			self._variables = dict(zip(keys, values))
+		return self._variables ##}}}
+
+	variables = property(get_variables)
 	
 	def parse_getstatus_players(self, data): ##{{{
 		"""
@@ -146,49 +352,78 @@ class Server(object): ##{{{
 		TODO
 		"""
 		assert len(data) > 0
-		self.players = []
+		self._players = parse_players(data, self.filter) ##}}}
 
-		for record in data:
-
-			match = REs.GETSTATUS.match(record)
-			if match:
-				negative, frags, ping, name = match.groups()
-				if negative == "-":
-					frags = "-" + frags
-				if self.filter:
-					name = self.filter_name(name)
-
-				player = Player()
-				player.frags = int(frags)
-				player.ping = int(ping)
-				player.name = name
-				self.players.append(player) ##}}}
-
-	def parse_getstatus(self, data): ##{{{
+	def parse_getstatus(self, data, accept=None): ##{{{
 		"""
 		Parse server response to getstatus command. The
 		first line of the response has lots of variables
 		while the following lines have players.
+
+		Players are kept unparsed until self.players is
+		first used. A reply that only differs from the last
+		one in player pings isn't parsed at all, the pings
+		shown are then those of the earlier reply. If
+		"accept" is given it is called with the server once
+		the variables are parsed, its verdict is returned.
 		"""
-		data = data.strip().split("\n")
+		variables, sep, players = data.strip().partition("\n")
+		digest = hash((variables, REs.PLAYER_PING.sub(r'\1 ', players)))
+		if digest == self.digest:
+			# same reply as last time, nothing to parse
+			return accept is None or bool(accept(self))
+		self.digest = digest
 
-		variables = data[0].strip()
-		players = data[1:]
+		self.rawplayers = players
+		self._players = None
+		self.playerhash = hash(tuple(normalize_names(REs.PLAYER_NAME.findall(players))))
+		self.detailed = True
+		self.parse_getstatus_variables(variables.strip())
 
-		self.parse_getstatus_variables(variables)
+		if accept is not None and not accept(self):
+			return False
+		return True ##}}}
 
-		if len(players) > 0:
-			self.parse_getstatus_players(players)
-		else:
-			self.players = []##}}}
+	def get_players(self): ##{{{
+		"""
+		List of players, parsed from the raw response
+		the first time it's used.
+		"""
+		if self._players is None:
+			if self.rawplayers:
+				self.parse_getstatus_players(self.rawplayers.split("\n"))
+			else:
+				self._players = []
+		return self._players ##}}}
 
-	def getstatus(self): ##{{{
+	players = property(get_players)
+
+	def getstatus(self, accept=None, pool=None, hedge=None, timeout=1.0, retries=3): ##{{{
 		"""
 		Basic server query for public information only.
+		Returns False if "accept" rejected the server, see
+		parse_getstatus. If no reply came after "hedge"
+		seconds a second getstatus is sent.
 		"""
-		status, data = self.connection.command("getstatus")
+		# statusResponse is a single packet
+		status, data = self.command("getstatus", pool, False, hedge, timeout, retries)
 		if status == "statusResponse":
-			self.parse_getstatus(data) ##}}}
+			return self.parse_getstatus(data, accept)
+		return True ##}}}
+
+	def getinfo(self, accept=None, pool=None, hedge=None, timeout=1.0, retries=3): ##{{{
+		"""
+		Light server query, the list columns without the
+		variable dump and player list of getstatus. Returns
+		like getstatus. A server whose reply doesn't have
+		the player counts is asked with getstatus instead.
+		"""
+		status, data = self.command("getinfo", pool, False, hedge, timeout, retries)
+		if status in ("infoResponse", "info"):
+			accepted = self.parse_getinfo(data, accept)
+			if accepted is not None:
+				return accepted
+		return self.getstatus(accept, pool, hedge, timeout, retries) ##}}}
 
 	def getPing(self): ##{{{
 		"""
@@ -212,25 +447,23 @@ class Server(object): ##{{{
 def MasterServer(host, port=27950, protocol=12, options="full empty", timeout=1): ##{{{
 	"""
 	Method to query master server and return a
-	list of ip addresses
+	set of packed addresses (see net.address)
 	"""
-	servers = set()
-	master = connection.Connection( host, port, timeout=timeout, size=65536)
 	## Warsow has
 	## requeststring = va( "%s %c%s %i %s %s", cmdname, toupper( modname[0] ), modname+1, SERVERBROWSER_PROTOCOL_VERSION,
 	##	 filter_allow_full ? "full" : "",
 	##	 filter_allow_empty ? "empty" : "" );
-	data = master.command_raw( "getservers Warsow %d %d %s" % ( protocol, protocol-1, options ) )
-	for pos in range(22, len(data)-7, 7):
-		sdata = data[pos:pos+7]
-		if sdata.startswith("\\"):
-			server = ""
-			for part in sdata[1:5]:
-				server += str(ord(part)) + "."
-			server = server [:-1] + ":"
-			server += str((ord(sdata[5])<<8) + ord(sdata[6]))
-			servers.add(server)
-	return servers ##}}}
+	with connection.Connection( host, port, timeout=timeout, size=65536) as master:
+		data = master.command_raw( "getservers Warsow %d %d %s" % ( protocol, protocol-1, options ) )
+	## "\xff\xff\xff\xffgetserversResponse" followed by records
+	## of "\\" and a packed address, ended by "\\EOT\0\0\0"
+	if len(data) < 22:
+		return set()
+	count = (len(data) - 22) // 7
+	records = struct.unpack_from("!" + "c6s" * count, data, 22)
+	return set(key for sep, key in zip(records[0::2], records[1::2])
+			if sep == "\\" and key != "EOT\0\0\0") ##}}}
 
 if __name__=='__main__':
-	print MasterServer('dpmaster.deathmask.net')
+	for key in MasterServer('dpmaster.deathmask.net'):
+		print address.to_string(key)
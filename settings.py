@@ -14,6 +14,9 @@ class settings(object):
 	##########
 
 	cfg = os.path.expanduser('~/.cursow')
+	negcache = os.path.expanduser('~/.cursow-dead')
+	cutoff = os.path.expanduser('~/.cursow-cutoff')
+	recorddb = os.path.expanduser('~/.cursow.db')
 
 	gendefaults = {#{{{
 			'Game' : 'Warsow 0.6',
@@ -26,6 +29,15 @@ class settings(object):
 			'Password' : 'show',
 			'Gametype' : 'all',
 			'Mod' : 'all',
+			'Per Host' : '2',
+			'Hedge Requests' : 'false',
+			'Scan Deadline' : 'none',
+			'Skip Dead Servers' : 'true',
+			'Two Phase Scan' : 'false',
+			'Auto Refresh' : 'false',
+			'Player Log' : '',
+			'Trend Column' : 'false',
+			'Record Population' : 'false',
 			}#}}}
 
 	wsw06defaults = {#{{{
@@ -123,6 +135,18 @@ class settings(object):
 		"""
 		self.cp.set( section, option, value )#}}}
 
+	def getGeneral(self, option):#{{{
+		"""
+		Get an option from the General section, falling back
+		to its default for settings files that predate it
+
+		arguments:
+		option -- option name
+		"""
+		if self.cp.has_option( 'General', option ):
+			return self.cp.get( 'General', option )
+		return self.gendefaults[ option ]#}}}
+
 	##########
 	# General Setting Interfaces
 	##########
@@ -159,6 +183,59 @@ class settings(object):
 		for key, val in self.cp.items( section ):
 			yield val#}}}
 
+	def addFriend(self, name):#{{{
+		"""
+		Add a player name to the friends list
+
+		arguments:
+		name -- player name to add
+		"""
+		if not self.cp.has_section( 'Friends' ):
+			self.cp.add_section( 'Friends' )
+		lastfriend = len( self.cp.options( 'Friends' ) )
+		while self.cp.has_option( 'Friends', 'friend%03d' % lastfriend ):
+			lastfriend += 1
+		self.cp.set( 'Friends', 'friend%03d' % lastfriend, name )#}}}
+
+	def delFriend(self, name):#{{{
+		"""
+		Remove a player name from the friends list
+
+		arguments:
+		name -- player name to delete
+		"""
+		if not self.cp.has_section( 'Friends' ):
+			return
+		for k,v in self.cp.items( 'Friends' ):
+			if v == name: self.cp.remove_option( 'Friends', k )#}}}
+
+	def getFriends(self):#{{{
+		"""
+		Generator returning the friends list
+		"""
+		if not self.cp.has_section( 'Friends' ):
+			return
+		for key, val in self.cp.items( 'Friends' ):
+			yield val#}}}
+
+	def getRules(self):#{{{
+		"""
+		Generator returning (name, expression, command) of
+		the alert rules, command is None if the rule only
+		shows a message. A rule "name" gets a command with a
+		"name.command" option
+		"""
+		if not self.cp.has_section( 'Rules' ):
+			return
+		for key, val in self.cp.items( 'Rules', raw=True ):
+			if key.endswith( '.command' ):
+				continue
+			command = key + '.command'
+			if self.cp.has_option( 'Rules', command ):
+				yield key, val, self.cp.get( 'Rules', command, raw=True )
+			else:
+				yield key, val, None#}}}
+
 	##########
 	# Display Options
 	##########
@@ -393,6 +470,161 @@ class settings(object):
 			index = 0
 		self.cp.set( 'General', 'Mod', self.mods[index] )#}}}
 
+	def getPerHost(self):#{{{
+		"""
+		Get how many servers of one host are queried at a time
+		"""
+		return self.getGeneral( 'Per Host' )#}}}
+
+	def incPerHost(self, n):#{{{
+		"""
+		Increments servers of one host queried at a time
+
+		arguments:
+		n -- amount to increment by
+		"""
+		value = self.getGeneral( 'Per Host' )
+		options = [ '1', '2', '3', '4', '8' ]
+		try:
+			index = (options.index( value )+n)%len( options )
+		except ValueError:
+			index = 0
+		self.cp.set( 'General', 'Per Host', options[index] )#}}}
+
+	def getHedge(self):#{{{
+		"""
+		Get whether to resend queries that are slower than most
+		"""
+		return self.getGeneral( 'Hedge Requests' ).lower() in ( '1', 'yes', 'true', 'on' )#}}}
+
+	def setHedge(self, value):#{{{
+		"""
+		Set whether to resend queries that are slower than most
+
+		arguments:
+		value -- bool to hedge requests
+		"""
+		value = str( value )
+		self.cp.set( 'General', 'Hedge Requests', value )#}}}
+
+	def getDeadline(self):#{{{
+		"""
+		Get seconds a refresh may take, 'none' for no limit
+		"""
+		return self.getGeneral( 'Scan Deadline' )#}}}
+
+	def incDeadline(self, n):#{{{
+		"""
+		Increments seconds a refresh may take
+
+		arguments:
+		n -- amount to increment by
+		"""
+		value = self.getGeneral( 'Scan Deadline' )
+		options = [ 'none', '0.5', '1', '1.5', '2', '3', '5', '10' ]
+		try:
+			index = (options.index( value.lower() )+n)%len( options )
+		except ValueError:
+			index = 0
+		self.cp.set( 'General', 'Scan Deadline', options[index] )#}}}
+
+	def getSkipDead(self):#{{{
+		"""
+		Get whether to skip servers that didn't answer lately
+		"""
+		return self.getGeneral( 'Skip Dead Servers' ).lower() in ( '1', 'yes', 'true', 'on' )#}}}
+
+	def setSkipDead(self, value):#{{{
+		"""
+		Set whether to skip servers that didn't answer lately
+
+		arguments:
+		value -- bool to skip dead servers
+		"""
+		value = str( value )
+		self.cp.set( 'General', 'Skip Dead Servers', value )#}}}
+
+	def getTwoPhase(self):#{{{
+		"""
+		Get whether to scan with getinfo and only get the
+		full status of servers when needed
+		"""
+		return self.getGeneral( 'Two Phase Scan' ).lower() in ( '1', 'yes', 'true', 'on' )#}}}
+
+	def setTwoPhase(self, value):#{{{
+		"""
+		Set whether to scan with getinfo first
+
+		arguments:
+		value -- bool to scan in two phases
+		"""
+		value = str( value )
+		self.cp.set( 'General', 'Two Phase Scan', value )#}}}
+
+	def getAutoRefresh(self):#{{{
+		"""
+		Get whether to keep polling servers after a scan
+		"""
+		return self.getGeneral( 'Auto Refresh' ).lower() in ( '1', 'yes', 'true', 'on' )#}}}
+
+	def setAutoRefresh(self, value):#{{{
+		"""
+		Set whether to keep polling servers after a scan
+
+		arguments:
+		value -- bool to refresh automatically
+		"""
+		value = str( value )
+		self.cp.set( 'General', 'Auto Refresh', value )#}}}
+
+	def getPlayerLog(self):#{{{
+		"""
+		Get the file player events are logged to, '' for none
+		"""
+		return os.path.expanduser( self.getGeneral( 'Player Log' ) )#}}}
+
+	def setPlayerLog(self, value):#{{{
+		"""
+		Set the file player events are logged to
+
+		arguments:
+		value -- path of the log, '' to log nothing
+		"""
+		self.cp.set( 'General', 'Player Log', value.strip() )#}}}
+
+	def getTrendColumn(self):#{{{
+		"""
+		Get whether to show the column of recent player counts
+		"""
+		return self.getGeneral( 'Trend Column' ).lower() in ( '1', 'yes', 'true', 'on' )#}}}
+
+	def setTrendColumn(self, value):#{{{
+		"""
+		Set whether to show the column of recent player counts
+
+		arguments:
+		value -- bool to show the column
+		"""
+		value = str( value )
+		self.cp.set( 'General', 'Trend Column', value )#}}}
+
+	def getRecord(self):#{{{
+		"""
+		Get whether to record the population of polled
+		servers in the history database
+		"""
+		return self.getGeneral( 'Record Population' ).lower() in ( '1', 'yes', 'true', 'on' )#}}}
+
+	def setRecord(self, value):#{{{
+		"""
+		Set whether to record the population of polled servers
+
+		arguments:
+		value -- bool to record
+		"""
+		value = str( value )
+		self.cp.set( 'General', 'Record Population', value )#}}}
+
 	def getPath(self):#{{{
 		"""
 		Get path to current game binary